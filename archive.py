@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+import hashlib
+import json
+import mmap
+import os
+import threading
+
+
+class RasterArchive:
+    """
+    Newsletters stored as printer-ready packed 1-bit rows.
+
+    All rows live in one append-only data file (archive.bin); a small JSON
+    index (archive.json) maps each newsletter ID to its offset, row width,
+    height and a SHA-256 of its rows. Reprinting memory-maps the data file
+    and hands out slices of it, so nothing is decoded or dithered again.
+    """
+
+    def __init__(self, directory: str = "newsletters"):
+        self.directory = directory
+        self.data_path = os.path.join(directory, "archive.bin")
+        self.index_path = os.path.join(directory, "archive.json")
+        self.lock = threading.Lock()
+        self._mmap = None
+        try:
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        except FileNotFoundError:
+            self.index = {}
+
+    def __contains__(self, key) -> bool:
+        return str(key) in self.index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def ids(self) -> list[str]:
+        """Return all archived IDs in sorted order."""
+        return sorted(self.index)
+
+    def add(self, key, image) -> dict:
+        """Dither and pack *image* and append it under *key* (see add_rows)."""
+        from raster import pack_image  # PIL is only needed when packing here
+        return self.add_rows(key, *pack_image(image))
+
+    def add_rows(self, key, rows: bytes, width_bytes: int, height: int) -> dict:
+        """
+        Append already packed *rows* under *key*.
+        An entry with identical rows is left alone; a changed one is replaced
+        (its old rows stay in the data file as dead space).
+        Returns the index entry.
+        """
+        digest = hashlib.sha256(rows).hexdigest()
+        key = str(key)
+        with self.lock:
+            entry = self.index.get(key)
+            if entry is not None and entry["sha256"] == digest:
+                return entry
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self.data_path, "ab") as f:
+                offset = f.tell()
+                f.write(rows)
+            entry = {"offset": offset, "width_bytes": width_bytes,
+                     "height": height, "sha256": digest}
+            self.index[key] = entry
+            self._save_index()
+            self._close_mmap()  # the data file grew
+            return entry
+
+    def rows(self, key) -> tuple[memoryview, int, int]:
+        """
+        Return (rows, width_bytes, height) for *key*, where *rows* is a
+        zero-copy view into the memory-mapped data file.
+        """
+        entry = self.index[str(key)]
+        with self.lock:
+            if self._mmap is None:
+                with open(self.data_path, "rb") as f:
+                    self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            size = entry["width_bytes"] * entry["height"]
+            view = memoryview(self._mmap)[entry["offset"]:entry["offset"] + size]
+        return view, entry["width_bytes"], entry["height"]
+
+    def close(self):
+        with self.lock:
+            self._close_mmap()
+
+    def _close_mmap(self):
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                pass  # a caller still holds a view, it goes away with it
+            self._mmap = None
+
+    def _save_index(self):
+        tmp = f"{self.index_path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.index, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.index_path)
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+
+from metrics import ASSET_REQUESTS
+from pathlib import Path
+from urllib.parse import urlsplit
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+
+# Requests that only feed analytics and never change what the page looks like
+TRACKER_HOSTS = (
+    "google-analytics.com",
+    "googletagmanager.com",
+    "doubleclick.net",
+    "facebook.net",
+    "facebook.com",
+    "hotjar.com",
+    "chimpstatic.com",  # Mailchimp's mc.js connect script
+)
+# Path segments of tracking endpoints, matched whole: /pixel but not /pixel-art.png
+TRACKER_PATHS = ("track", "pixel", "pixel.gif", "collect")
+
+# Static resources worth keeping across newsletters
+CACHED_TYPES = {"image", "font", "stylesheet"}
+
+
+def is_tracker(url: str) -> bool:
+    parts = urlsplit(url)
+    host = parts.hostname or ""
+    return (any(host == h or host.endswith("." + h) for h in TRACKER_HOSTS)
+            or any(segment in TRACKER_PATHS for segment in parts.path.lower().split("/")))
+
+
+class AssetCache:
+    """
+    Persistent, content-addressed cache for the static assets of rendered pages.
+
+    Bodies are stored once per SHA-256 under *directory*/objects, so the
+    same logo behind different URLs takes space only once. A small SQLite
+    index maps URLs to their body and records when each was last used; once
+    the bodies exceed *max_mb*, the least recently used ones are evicted.
+
+    Install it on a Playwright context with context.route("**/*", cache.handler())
+    (or async_handler() for the async API): trackers are aborted, cached
+    images, fonts and stylesheets are served from disk and everything else
+    goes to the network, where cacheable responses are stored on the way.
+    """
+
+    def __init__(self, directory: str = "cache/assets", max_mb: int = 200):
+        self.directory = Path(directory)
+        self.objects = self.directory / "objects"
+        self.objects.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_mb * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+        self.blocked = 0
+
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(self.directory / "index.db"), check_same_thread=False)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS assets (
+                url TEXT PRIMARY KEY,
+                sha256 TEXT NOT NULL,
+                content_type TEXT,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            )
+        """)
+        self.db.execute("CREATE INDEX IF NOT EXISTS assets_last_used ON assets (last_used)")
+        self.db.commit()
+
+    def get(self, url: str) -> tuple[bytes, str] | None:
+        """Return (body, content type) of a cached *url* or None."""
+        with self.lock:
+            row = self.db.execute("SELECT sha256, content_type FROM assets WHERE url = ?",
+                                  (url,)).fetchone()
+            if row is None:
+                return None
+            try:
+                body = (self.objects / row[0]).read_bytes()
+            except OSError:
+                self.db.execute("DELETE FROM assets WHERE url = ?", (url,))
+                self.db.commit()
+                return None
+            self.db.execute("UPDATE assets SET last_used = ? WHERE url = ?", (time.time(), url))
+            self.db.commit()
+        return body, row[1]
+
+    def put(self, url: str, body: bytes, content_type: str | None):
+        """Store *body* for *url* and evict old assets if the cache grew too big."""
+        digest = hashlib.sha256(body).hexdigest()
+        path = self.objects / digest
+        with self.lock:
+            if not path.exists():
+                tmp = path.with_suffix(".part")
+                tmp.write_bytes(body)
+                os.replace(tmp, path)
+            self.db.execute("""
+                INSERT INTO assets (url, sha256, content_type, size, last_used) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(url) DO UPDATE SET
+                    sha256 = excluded.sha256,
+                    content_type = excluded.content_type,
+                    size = excluded.size,
+                    last_used = excluded.last_used
+            """, (url, digest, content_type, len(body), time.time()))
+            self.db.commit()
+            self._evict()
+
+    def size(self) -> int:
+        """Bytes on disk, counting every distinct body once."""
+        with self.lock:
+            return self._size()
+
+    def _size(self) -> int:
+        row = self.db.execute(
+            "SELECT SUM(size) FROM (SELECT MAX(size) AS size FROM assets GROUP BY sha256)").fetchone()
+        return row[0] or 0
+
+    def _evict(self):
+        total = self._size()
+        if total <= self.max_bytes:
+            return
+        # evict down to 90 %, so we don't run this on every new asset
+        target = self.max_bytes * 0.9
+        rows = self.db.execute("SELECT url, sha256 FROM assets ORDER BY last_used").fetchall()
+        evicted = 0
+        for url, digest in rows:
+            if total <= target:
+                break
+            self.db.execute("DELETE FROM assets WHERE url = ?", (url,))
+            evicted += 1
+            if self.db.execute("SELECT 1 FROM assets WHERE sha256 = ?", (digest,)).fetchone() is None:
+                path = self.objects / digest
+                try:
+                    total -= path.stat().st_size
+                    path.unlink()
+                except OSError:
+                    pass
+        self.db.commit()
+        print(f"Asset cache evicted {evicted} entries, {total / 1024 / 1024:.0f} MB left")
+
+    def _lookup(self, request):
+        """Decide what to do with *request*: ("block"|"serve"|"fetch"|"pass", cached)."""
+        if is_tracker(request.url):
+            self.blocked += 1
+            ASSET_REQUESTS.inc(result="blocked")
+            return "block", None
+        if request.method != "GET" or request.resource_type not in CACHED_TYPES:
+            return "pass", None
+        cached = self.get(request.url)
+        if cached is not None:
+            self.hits += 1
+            ASSET_REQUESTS.inc(result="cached")
+            return "serve", cached
+        self.misses += 1
+        ASSET_REQUESTS.inc(result="fetched")
+        return "fetch", None
+
+    @staticmethod
+    def _headers(content_type: str | None) -> dict:
+        # fonts are fetched with CORS, the cached copy has to allow it too
+        headers = {"access-control-allow-origin": "*"}
+        if content_type:
+            headers["content-type"] = content_type
+        return headers
+
+    def handler(self):
+        """Route handler for Playwright's sync API."""
+        def handle(route):
+            action, cached = self._lookup(route.request)
+            if action == "block":
+                route.abort("blockedbyclient")
+            elif action == "serve":
+                route.fulfill(status=200, body=cached[0], headers=self._headers(cached[1]))
+            elif action == "fetch":
+                response = route.fetch()
+                body = response.body()
+                if response.status == 200:
+                    self.put(route.request.url, body, response.headers.get("content-type"))
+                route.fulfill(response=response, body=body)
+            else:
+                route.continue_()
+        return handle
+
+    def async_handler(self):
+        """Route handler for Playwright's async API."""
+        async def handle(route):
+            action, cached = self._lookup(route.request)
+            if action == "block":
+                await route.abort("blockedbyclient")
+            elif action == "serve":
+                await route.fulfill(status=200, body=cached[0], headers=self._headers(cached[1]))
+            elif action == "fetch":
+                response = await route.fetch()
+                body = await response.body()
+                if response.status == 200:
+                    self.put(route.request.url, body, response.headers.get("content-type"))
+                await route.fulfill(response=response, body=body)
+            else:
+                await route.continue_()
+        return handle
+
+    def stats(self) -> str:
+        return f"{self.hits} cached, {self.misses} fetched, {self.blocked} blocked"
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,598 @@
+#!/usr/bin/env python
+"""
+End-to-end benchmark of the prnti daemon, runnable offline.
+
+Three local stand-ins replace the outside world:
+- FakeImapServer: a small IMAP4rev1 server with IDLE that MailMonitor talks to,
+- PageServer: an HTTP server serving saved copies of the newsletters
+  (bench/pages/<slug>.html, see `benchmark.py save`) or generated pages,
+- escpos' Dummy printer, which records every byte it is sent.
+
+The real pipeline from prnti.py runs against them and the harness reports
+per-stage timings, mail-to-paper latency, throughput, bytes sent over IMAP
+and to the printer, and peak RSS.
+
+    python benchmark.py                      # single mail, a backlog of 5, the backlog isolated
+    python benchmark.py --scenario backlog -n 20 --mode stream
+    python benchmark.py save                 # download pages for offline use
+"""
+
+from mailbox import MailMonitor, _parse_imap
+from supervisor import ProcessMailMonitor
+from pipeline import Job
+from spooler import PrintSpooler
+from archive import RasterArchive
+from store import NewsletterStore
+from prnti import build_pipeline
+from browser import _process_tree_rss_mb
+from escpos.printer import Dummy
+from argparse import ArgumentParser
+from csv import DictReader
+from email.message import EmailMessage
+from email.policy import SMTP
+from email import message_from_bytes
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+from urllib.parse import urlsplit
+from urllib.request import urlopen
+import itertools
+import json
+import os
+import random
+import re
+import resource
+import select
+import socketserver
+import statistics
+import tempfile
+import threading
+import time
+
+
+SENDER = "redaktion@wnti.ch"
+PAGES_DIR = Path("bench/pages")
+
+
+# --- IMAP -------------------------------------------------------------------
+
+def _bodystructure(part) -> str:
+    """BODYSTRUCTURE of an email.message part, enough for mailbox._text_parts."""
+    if part.is_multipart():
+        children = "".join(_bodystructure(child) for child in part.get_payload())
+        return f'({children} "{part.get_content_subtype()}")'
+    body = _part_bytes(part)
+    charset = part.get_content_charset()
+    params = f'("charset" "{charset}")' if charset else "NIL"
+    encoding = part.get("Content-Transfer-Encoding", "7bit")
+    structure = f'"{part.get_content_maintype()}" "{part.get_content_subtype()}" {params} NIL NIL "{encoding}" {len(body)}'
+    if part.get_content_maintype() == "text":
+        lines = body.count(b"\n")
+        structure += f" {lines}"
+    return f"({structure})"
+
+
+def _part_bytes(part) -> bytes:
+    payload = part.get_payload()
+    return payload.encode("utf-8", "surrogateescape") if isinstance(payload, str) else b""
+
+
+def _section(msg, raw: bytes, section: str) -> bytes:
+    """The bytes of a BODY[section] of *msg*."""
+    header_end = raw.find(b"\r\n\r\n") + 4
+    if section == "":
+        return raw
+    if section == "HEADER":
+        return raw[:header_end]
+    if section == "TEXT":
+        return raw[header_end:]
+    if section.startswith("HEADER.FIELDS"):
+        wanted = re.findall(r"[\w-]+", section.split("(", 1)[1].upper())
+        lines = [f"{k}: {v}" for k, v in msg.items() if k.upper() in wanted]
+        return ("\r\n".join(lines) + "\r\n\r\n").encode()
+    part = msg
+    for number in section.split("."):
+        if part.is_multipart():
+            part = part.get_payload()[int(number) - 1]
+    return _part_bytes(part)
+
+
+def _uid_set(spec: str, uids: list[int]) -> set[int]:
+    top = max(uids, default=0)
+    found = set()
+    for piece in spec.split(","):
+        start, _, end = piece.partition(":")
+        start = top if start == "*" else int(start)
+        end = start if not end else top if end == "*" else int(end)
+        found.update(range(min(start, end), max(start, end) + 1))
+    if spec.endswith("*") and uids:
+        found.add(top)  # n:* always includes the highest UID
+    return found
+
+
+class FakeImapServer(socketserver.ThreadingTCPServer):
+    """A tiny in-memory IMAP4rev1 server with IDLE, just enough for MailSession."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        super().__init__((host, port), _ImapHandler)
+        self.port = self.server_address[1]
+        self.messages = []  # dicts with uid, flags, raw, msg
+        self.lock = threading.Lock()
+        self.bytes_sent = 0
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def append(self, msg: EmailMessage):
+        raw = msg.as_bytes(policy=SMTP)
+        with self.lock:
+            uid = len(self.messages) + 1
+            self.messages.append({"uid": uid, "flags": set(), "raw": raw,
+                                  "msg": message_from_bytes(raw)})
+
+
+class _ImapHandler(socketserver.StreamRequestHandler):
+
+    def send(self, data: bytes | str):
+        if isinstance(data, str):
+            data = data.encode()
+        self.server.bytes_sent += len(data)
+        self.wfile.write(data)
+        self.wfile.flush()
+
+    def handle(self):
+        self.send("* OK [CAPABILITY IMAP4rev1 IDLE] bench IMAP ready\r\n")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            tag, _, rest = line.rstrip(b"\r\n").partition(b" ")
+            command, _, args = rest.partition(b" ")
+            command = command.upper().decode()
+            uid = command == "UID"
+            if uid:
+                command, _, args = args.partition(b" ")
+                command = command.upper().decode()
+            handler = getattr(self, f"cmd_{command.lower()}", None)
+            if handler is None:
+                self.send(tag + b" BAD unknown command\r\n")
+                continue
+            if handler(tag.decode(), args) is False:
+                return
+
+    def ok(self, tag: str, text: str = "completed"):
+        self.send(f"{tag} OK {text}\r\n")
+
+    def cmd_capability(self, tag, args):
+        self.send("* CAPABILITY IMAP4rev1 IDLE\r\n")
+        self.ok(tag)
+
+    def cmd_login(self, tag, args):
+        self.ok(tag, "LOGIN completed")
+
+    def cmd_logout(self, tag, args):
+        self.send("* BYE\r\n")
+        self.ok(tag)
+        return False
+
+    def cmd_noop(self, tag, args):
+        self.ok(tag)
+
+    def cmd_expunge(self, tag, args):
+        self.ok(tag)
+
+    def cmd_select(self, tag, args):
+        with self.server.lock:
+            count = len(self.server.messages)
+        self.send(f"* {count} EXISTS\r\n* 0 RECENT\r\n* FLAGS (\\Seen)\r\n"
+                  f"* OK [UIDVALIDITY 1] UIDs valid\r\n* OK [UIDNEXT {count + 1}] next UID\r\n")
+        self.ok(tag, "[READ-WRITE] SELECT completed")
+
+    def cmd_status(self, tag, args):
+        with self.server.lock:
+            count = len(self.server.messages)
+        self.send(f'* STATUS "INBOX" (UIDVALIDITY 1 UIDNEXT {count + 1} MESSAGES {count})\r\n')
+        self.ok(tag)
+
+    def cmd_search(self, tag, args):
+        tokens = []
+        pending = _parse_imap(args)
+        while pending:
+            token = pending.pop(0)
+            if isinstance(token, list):
+                pending[:0] = token
+            else:
+                tokens.append(token.decode())
+        with self.server.lock:
+            messages = list(self.server.messages)
+        uids = [m["uid"] for m in messages]
+        matches = set(uids)
+        i = 0
+        while i < len(tokens):
+            key = tokens[i].upper()
+            if key == "CHARSET":
+                i += 1
+            elif key == "FROM":
+                i += 1
+                needle = tokens[i].lower()
+                matches &= {m["uid"] for m in messages if needle in m["msg"].get("From", "").lower()}
+            elif key == "UNSEEN":
+                matches &= {m["uid"] for m in messages if "\\Seen" not in m["flags"]}
+            elif key == "UID":
+                i += 1
+                matches &= _uid_set(tokens[i], uids)
+            i += 1
+        self.send(f"* SEARCH {' '.join(str(uid) for uid in sorted(matches))}\r\n".replace(" \r", "\r"))
+        self.ok(tag)
+
+    def cmd_fetch(self, tag, args):
+        spec, _, items = args.partition(b" ")
+        items = _parse_imap(items)[0]
+        items = items if isinstance(items, list) else [items]
+        with self.server.lock:
+            messages = list(self.server.messages)
+        wanted = _uid_set(spec.decode(), [m["uid"] for m in messages])
+        for seq, message in enumerate(messages, 1):
+            if message["uid"] not in wanted:
+                continue
+            out = [f"* {seq} FETCH (UID {message['uid']}".encode()]
+            for item in items:
+                name = item.decode()
+                upper = name.upper()
+                if upper in ("UID",):
+                    continue
+                if upper == "FLAGS":
+                    out.append(f" FLAGS ({' '.join(message['flags'])})".encode())
+                elif upper == "RFC822.SIZE":
+                    out.append(f" RFC822.SIZE {len(message['raw'])}".encode())
+                elif upper == "BODYSTRUCTURE":
+                    out.append(b" BODYSTRUCTURE " + _bodystructure(message["msg"]).encode())
+                elif upper.startswith("BODY"):
+                    match = re.match(r"BODY(\.PEEK)?\[(.*)\](?:<(\d+)\.(\d+)>)?$", name, re.I)
+                    peek, section, offset, length = match.groups()
+                    data = _section(message["msg"], message["raw"], section)
+                    key = f"BODY[{section}]"
+                    if offset is not None:
+                        data = data[int(offset):int(offset) + int(length)]
+                        key += f"<{offset}>"
+                    if not peek:
+                        message["flags"].add("\\Seen")
+                    out.append(f" {key} {{{len(data)}}}\r\n".encode() + data)
+            self.send(b"".join(out) + b")\r\n")
+        self.ok(tag)
+
+    def cmd_store(self, tag, args):
+        spec, _, rest = args.partition(b" ")
+        with self.server.lock:
+            messages = list(self.server.messages)
+        wanted = _uid_set(spec.decode(), [m["uid"] for m in messages])
+        add = not rest.startswith(b"-")
+        flags = re.findall(r"\\\w+", rest.decode())
+        for seq, message in enumerate(messages, 1):
+            if message["uid"] in wanted:
+                (message["flags"].update if add else message["flags"].difference_update)(flags)
+                self.send(f"* {seq} FETCH (UID {message['uid']} FLAGS ({' '.join(message['flags'])}))\r\n")
+        self.ok(tag)
+
+    def cmd_idle(self, tag, args):
+        self.send("+ idling\r\n")
+        with self.server.lock:
+            known = len(self.server.messages)
+        sock = self.connection
+        while True:
+            readable, _, _ = select.select([sock], [], [], 0.1)
+            if readable:
+                line = self.rfile.readline()
+                if not line or line.strip().upper() == b"DONE":
+                    break
+            with self.server.lock:
+                count = len(self.server.messages)
+            if count != known:
+                self.send(f"* {count} EXISTS\r\n")
+                known = count
+        self.ok(tag, "IDLE terminated")
+
+
+# --- HTTP -------------------------------------------------------------------
+
+def generate_page(slug: str, paragraphs: int = 60) -> bytes:
+    """A newsletter-like page: headings, text and inline images, no external requests."""
+    rnd = random.Random(slug)
+    words = "wnti velo stadt zeitung quartier bern kultur politik leserinnen brief".split()
+    body = [f"<h1>{slug.replace('-', ' ').title()}</h1>"]
+    for i in range(paragraphs):
+        if i % 10 == 0:
+            body.append(f"<h2>Abschnitt {i // 10 + 1}</h2>")
+            color = "#%06x" % rnd.randrange(0xffffff)
+            body.append(f'<svg width="100%" height="180"><rect width="100%" height="180" fill="{color}"/></svg>')
+        body.append("<p>" + " ".join(rnd.choice(words) for _ in range(80)) + "</p>")
+    html = ("<!doctype html><html><head><meta charset='utf-8'>"
+            "<meta name='viewport' content='width=device-width'></head>"
+            f"<body style='font-family:sans-serif;margin:12px'>{''.join(body)}</body></html>")
+    return html.encode()
+
+
+class PageServer(ThreadingHTTPServer):
+    """Serves bench/pages/<slug>.html, or a generated page if none was saved."""
+
+    daemon_threads = True
+
+    def __init__(self, pages_dir: Path = PAGES_DIR, host: str = "127.0.0.1", port: int = 0):
+        super().__init__((host, port), _PageHandler)
+        self.pages_dir = pages_dir
+        self.port = self.server_address[1]
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def url(self, article_url: str) -> str:
+        """Map a mailchi.mp article URL to the local copy, keeping its query."""
+        query = urlsplit(article_url).query
+        return f"http://127.0.0.1:{self.port}/{slug_of(article_url)}" + (f"?{query}" if query else "")
+
+    @property
+    def url_pattern(self) -> str:
+        """Like mailbox.ARTICLE_URL_PATTERN, for the URLs of url()."""
+        return rf'http://127\.0\.0\.1:{self.port}/[A-Za-z0-9\-_]+(?:[?&][^"\s<>()]+)*'
+
+
+class _PageHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        slug = self.path.strip("/").split("?")[0]
+        saved = self.server.pages_dir / f"{slug}.html"
+        body = saved.read_bytes() if saved.is_file() else generate_page(slug)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def slug_of(url: str) -> str:
+    return urlsplit(url).path.rstrip("/").rsplit("/", 1)[-1]
+
+
+def save_pages(pages_dir: Path = PAGES_DIR):
+    """Download the HTML of every newsletter in newsletters.csv for offline runs."""
+    pages_dir.mkdir(parents=True, exist_ok=True)
+    for newsletter in DictReader(open("newsletters.csv")):
+        if not newsletter["url"]:
+            continue
+        path = pages_dir / f"{slug_of(newsletter['url'])}.html"
+        if path.is_file():
+            continue
+        print(f"Saving {newsletter['url']}")
+        with urlopen(newsletter["url"], timeout=30) as response:
+            path.write_bytes(response.read())
+
+
+# --- harness ----------------------------------------------------------------
+
+def newsletter_mail(article_url: str, image_kb: int = 300) -> EmailMessage:
+    """A Mailchimp-like mail: text and HTML alternatives plus a heavy inline image."""
+    msg = EmailMessage()
+    msg["From"] = f"WNTI <{SENDER}>"
+    msg["To"] = "prnti@example.com"
+    msg["Subject"] = f"Neues von wnti: {slug_of(article_url)}"
+    msg["Date"] = time.strftime("%a, %d %b %Y %H:%M:%S +0000", time.gmtime())
+    msg.set_content(f"Die Online-Version findest du hier:\n{article_url}\n\n" + "Lorem ipsum. " * 200,
+                    cte="quoted-printable")
+    msg.add_alternative(f"<html><body><a href=\"{article_url}\">Online lesen</a>"
+                        + "<p>Lorem ipsum.</p>" * 200 + "</body></html>", subtype="html")
+    msg.get_payload()[1].add_related(os.urandom(image_kb * 1024), "image", "png", cid="<logo>")
+    return msg
+
+
+def article_urls(count: int) -> list[str]:
+    urls = [n["url"] for n in DictReader(open("newsletters.csv")) if n["url"]]
+    return [urls[i % len(urls)].replace("?e=", f"?b={i}&e=") for i in range(count)]
+
+
+class Timings:
+    """Thread-safe collection of per-stage durations."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages: dict[str, list[float]] = {}
+
+    def add(self, name: str, seconds: float):
+        with self.lock:
+            self.stages.setdefault(name, []).append(seconds)
+
+    def wrap(self, name: str, func):
+        def timed(job):
+            start = time.perf_counter()
+            result = func(job)
+            if result is None:
+                return None
+            if isinstance(result, Job):
+                self.add(name, time.perf_counter() - start)
+                return result
+            return self._timed_iter(name, result, time.perf_counter() - start)
+        return timed
+
+    def _timed_iter(self, name, results, elapsed):
+        results = iter(results)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(results)
+            except StopIteration:
+                break
+            finally:
+                elapsed += time.perf_counter() - start
+            yield item
+        self.add(name, elapsed)
+
+
+def run_scenario(name: str, count: int, mode: str, backlog: bool, timeout: float,
+                 isolate: bool = False) -> dict:
+    """
+    Run the prnti pipeline against the stand-ins until *count* newsletters are
+    printed. With *isolate* IMAP and the browser run in supervised child
+    processes (ProcessMailMonitor, RenderWorker), as the daemon does by default.
+    """
+    print(f"\n=== {name}: {count} newsletter(s), mode {mode}{', isolated' if isolate else ''} ===")
+    workdir = Path(tempfile.mkdtemp(prefix="prnti-bench-"))
+    imap = FakeImapServer().start()
+    pages = PageServer().start()
+    printers = []
+
+    def connect():
+        printers.append(Dummy())
+        return printers[-1]
+
+    # the mails link to the local copies, so the pipeline handles the URL it renders
+    mails = [newsletter_mail(pages.url(url)) for url in article_urls(count)]
+    if backlog:
+        for mail in mails:
+            imap.append(mail)
+
+    monitor_class = ProcessMailMonitor if isolate else MailMonitor
+    monitor = monitor_class(SENDER, "127.0.0.1", "bench", "bench", mail_timeout=30,
+                            port=imap.port, ssl=False, state_path=str(workdir / "mail_state.json"))
+    spooler = PrintSpooler(connect).start()
+    store = NewsletterStore(str(workdir / "prnti.db"))
+    pipeline = build_pipeline(monitor, spooler, store, RasterArchive(str(workdir / "cache")), mode,
+                              isolate=isolate)
+
+    timings = Timings()
+    printed = []
+    arrived = {}
+    stages = {stage.name: stage for stage in pipeline.stages}
+
+    ingest = stages["ingest"].func
+    def timed_ingest(job):
+        result = ingest(job)
+        if result is not None:
+            arrived[result.seq] = time.perf_counter()
+            result.msg.url_pattern = pages.url_pattern
+        return result
+    stages["ingest"].func = timed_ingest
+
+    print_job = stages["print"].func
+    def timed_print(job):
+        job = print_job(job)
+        if job.last:
+            printed.append((job.seq, time.perf_counter()))
+        return job
+    stages["print"].func = timed_print
+
+    for stage in pipeline.stages[1:]:
+        stage.func = timings.wrap(stage.name, stage.func)
+
+    start = time.perf_counter()
+    monitor.start()
+    pipeline.start()
+    if not backlog:
+        time.sleep(2)  # let the monitor settle into IDLE
+        start = time.perf_counter()
+        for mail in mails:
+            imap.append(mail)
+
+    # Chromium is a grandchild, ru_maxrss never sees it: sample the whole process tree
+    deadline = time.time() + timeout
+    peak_rss = _process_tree_rss_mb()
+    for tick in itertools.count():
+        if len(printed) >= count or time.time() >= deadline:
+            break
+        if tick % 10 == 0:
+            peak_rss = max(peak_rss, _process_tree_rss_mb())
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - start
+
+    monitor.stop()
+    pipeline.stop()
+    spooler.stop()
+    store.close()
+    imap.stop()
+    pages.stop()
+
+    latencies = [t - start for _, t in printed]
+    result = {
+        "scenario": name,
+        "mode": mode,
+        "isolated": isolate,
+        "newsletters": count,
+        "printed": len(printed),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_per_min": round(len(printed) / elapsed * 60, 2) if elapsed else 0,
+        "first_paper_s": round(min(latencies), 3) if latencies else None,
+        "mail_to_ingest_s": round(min(arrived.values()) - start, 3) if arrived else None,
+        "imap_bytes": imap.bytes_sent,
+        "printer_bytes": sum(len(p.output) for p in printers),
+        "stages": {stage: {"count": len(values),
+                           "mean_s": round(statistics.mean(values), 4),
+                           "max_s": round(max(values), 4),
+                           "total_s": round(sum(values), 4)}
+                   for stage, values in timings.stages.items()},
+        "peak_rss_mb": round(peak_rss, 1),
+        "peak_rss_self_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+    return result
+
+
+def report(result: dict):
+    print(f"\n--- {result['scenario']} ({result['mode']}{', isolated' if result['isolated'] else ''}) ---")
+    print(f"printed {result['printed']}/{result['newsletters']} in {result['elapsed_s']:.2f}s "
+          f"({result['throughput_per_min']} newsletters/min)")
+    print(f"first paper after {result['first_paper_s']}s, mail ingested after {result['mail_to_ingest_s']}s")
+    print(f"IMAP bytes {result['imap_bytes']:,}, printer bytes {result['printer_bytes']:,}")
+    print(f"peak RSS {result['peak_rss_mb']} MB with the browser (this process {result['peak_rss_self_mb']} MB)")
+    print(f"{'stage':<12}{'count':>6}{'mean s':>10}{'max s':>10}{'total s':>10}")
+    for stage, t in result["stages"].items():
+        print(f"{stage:<12}{t['count']:>6}{t['mean_s']:>10.3f}{t['max_s']:>10.3f}{t['total_s']:>10.3f}")
+
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser(description="Benchmark the prnti pipeline against local stand-ins.")
+    parser.add_argument("action", nargs="?", choices=["run", "save"], default="run",
+                        help="run the benchmark (default) or save the newsletter pages for offline use")
+    parser.add_argument("-s", "--scenario", choices=["single", "backlog", "isolated", "all"], default="all",
+                        help="single: one mail while idling; backlog: -n mails waiting at startup; "
+                             "isolated: the backlog with IMAP and the browser in supervised child "
+                             "processes, the daemon's default (default: all)")
+    parser.add_argument("-n", "--backlog-size", type=int, default=5,
+                        help="Number of mails waiting in the backlog scenario (default: 5)")
+    parser.add_argument("-m", "--mode", choices=["raster", "stream"], default="raster")
+    parser.add_argument("-t", "--timeout", type=float, default=600,
+                        help="Give up on a scenario after this many seconds (default: 600)")
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    if args.action == "save":
+        save_pages()
+    else:
+        results = []
+        if args.scenario in ("single", "all"):
+            results.append(run_scenario("single", 1, args.mode, backlog=False, timeout=args.timeout))
+        if args.scenario in ("backlog", "all"):
+            results.append(run_scenario("backlog", args.backlog_size, args.mode, backlog=True,
+                                        timeout=args.timeout))
+        if args.scenario in ("isolated", "all"):
+            results.append(run_scenario("isolated", args.backlog_size, args.mode, backlog=True,
+                                        timeout=args.timeout, isolate=True))
+        for result in results:
+            report(result)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(results, f, indent=2)
@@ -1,64 +1,400 @@
 #!/usr/bin/env python
 
 from pathlib import Path
-from playwright.sync_api import sync_playwright
 
 
+import io
+import os
+import queue
 import sys
 from argparse import ArgumentParser
+from contextlib import contextmanager
 from PIL import Image
+from metrics import STAGE_SECONDS
 
-def resize_image(path: str, width: int = 830) -> Image.Image:
+# Resolves once every image on the page is loaded and decoded and the web
+# fonts are in, instead of scrolling with fixed sleeps. Lazy images are
+# switched to eager loading and one jump to the bottom wakes up script-based
+# lazy loaders. Gives up after *timeout* ms, a broken image must not hang us.
+READY_SCRIPT = """
+    async (timeout) => {
+        document.querySelectorAll('img[loading="lazy"]').forEach(img => img.loading = 'eager');
+        window.scrollTo(0, document.body.scrollHeight);
+        const loaded = img => img.complete
+            ? Promise.resolve()
+            : new Promise(r => { img.addEventListener('load', r); img.addEventListener('error', r); });
+        const ready = Promise.all([
+            document.fonts.ready,
+            ...Array.from(document.images, img => loaded(img).then(() => img.decode()).catch(() => {})),
+        ]);
+        await Promise.race([ready, new Promise(r => setTimeout(r, timeout))]);
+        window.scrollTo(0, 0);          // back to top for clean shot
+    }
+"""
+READY_TIMEOUT = 15000
+
+# Largest screenshot taken in one go: 830 x 20000 px is about 66 MB as RGBA
+MAX_PIXELS = 830 * 20000
+
+
+class PageTooLarge(Exception):
+    """The page needs more pixels than the budget allows."""
+
+
+def print_profile(device: dict, width: int) -> dict:
+    """
+    Copy of a Playwright *device* descriptor whose device scale factor makes
+    screenshots exactly *width* px wide, the printer's dot width, so they
+    need no resampling. The CSS viewport, and with it the mobile layout,
+    stays the same: an iPhone 12 renders at 390 CSS px either way, but at
+    2.13 instead of 3 device px each for an 830 dot printer.
+    """
+    profile = dict(device)
+    profile["device_scale_factor"] = width / device["viewport"]["width"]
+    return profile
+
+
+def wait_until_ready(page, timeout: int = READY_TIMEOUT):
+    """Load *page* far enough to screenshot it, see READY_SCRIPT."""
+    page.evaluate(READY_SCRIPT, timeout)
+
+
+def resize_image(image: str | Path | Image.Image, width: int = 830) -> Image.Image:
+    """
+    Resize the image (a path or an already opened PIL image) to the specified
+    width while maintaining the aspect ratio.
+    """
+    if not isinstance(image, Image.Image):
+        with Image.open(image) as img:
+            return resize_image(img, width)
+    orig_width, orig_height = image.size
+    if orig_width == width:
+        return image  # rendered at print width, nothing to do
+    scale_factor = width / float(orig_width)
+    new_height = int(orig_height * scale_factor)
+    resized = image.resize((width, new_height))
+    return resized
+
+
+def to_print_image(image: str | Path | Image.Image, width: int = 830) -> Image.Image:
+    """Resize *image* to the printer width and rotate it by 180°."""
+    print("Resizing image...")
+    with STAGE_SECONDS.time(stage="resize"):
+        return resize_image(image, width=width).rotate(180)
+
+
+def save_image(image: Image.Image, path: str | Path):
+    """Save *image*, dropping the alpha channel where the format has none."""
+    if str(path).lower().endswith((".jpg", ".jpeg")):
+        image = image.convert("RGB")
+    image.save(path)
+
+
+def _process_tree_rss_mb(root_pid: int | None = None) -> float:
+    """
+    Sum the resident memory of *root_pid* (default: this process) and all
+    its descendants in MB. Chromium runs as a grandchild of the Python
+    process (via the Playwright driver), so this is how we see its footprint.
+    Returns 0.0 where /proc is not available.
+    """
+    root_pid = root_pid or os.getpid()
+    children: dict[int, list[int]] = {}
+    try:
+        for entry in os.listdir("/proc"):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    stat = f.read()
+            except OSError:
+                continue
+            # the command name may contain spaces, so split after the closing paren
+            ppid = int(stat.rsplit(")", 1)[1].split()[1])
+            children.setdefault(ppid, []).append(int(entry))
+    except OSError:
+        return 0.0
+
+    total_kb = 0
+    pending = [root_pid]
+    while pending:
+        pid = pending.pop()
+        pending.extend(children.get(pid, []))
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total_kb += int(line.split()[1])
+                        break
+        except OSError:
+            continue
+    return total_kb / 1024
+
+
+class BrowserPool:
+    """
+    Long-lived headless Chromium with a pool of reusable device contexts.
+
+    Launching Chromium is the slowest part of taking a screenshot on the Pi,
+    so the pool keeps one browser running and hands out pages from *size*
+    pre-built contexts. The browser is health-checked before every page and
+    recycled after *max_pages* pages or once the browser process tree grows
+    beyond *max_rss_mb*.
+    With *print_width* the contexts render straight at that width (see
+    print_profile) instead of the device's native resolution.
+
+    Playwright's sync API is bound to the thread that started it, so a pool
+    must be created and used from one thread.
+    """
+
+    def __init__(self, size: int = 1, device_name: str = "iPhone 12",
+                 max_pages: int = 50, max_rss_mb: int = 700, asset_cache=None,
+                 print_width: int | None = None):
+        self.size = size
+        self.device_name = device_name
+        self.print_width = print_width
+        self.max_pages = max_pages
+        self.max_rss_mb = max_rss_mb
+        self.asset_cache = asset_cache  # assets.AssetCache, blocks trackers and caches static files
+
+        self._playwright = None
+        self._browser = None
+        self._contexts = queue.Queue()
+        self.pages_since_launch = 0
+        self.launch_count = 0
+
+    def start(self):
+        """Start Playwright and launch the browser."""
+        if self._playwright is None:
+            # imported here, so importing this module stays cheap for the daemon's cold start
+            from playwright.sync_api import sync_playwright
+            self._playwright = sync_playwright().start()
+        if self._browser is None:
+            self._launch()
+        return self
+
+    def stop(self):
+        """Close the browser and stop Playwright."""
+        self._close_browser()
+        if self._playwright is not None:
+            self._playwright.stop()
+            self._playwright = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def _launch(self):
+        print("Launching browser...")
+        device = self._playwright.devices[self.device_name]  # iPhone, Pixel, Galaxy, …
+        if self.print_width:
+            device = print_profile(device, self.print_width)
+        self._browser = self._playwright.chromium.launch(headless=True)
+        for _ in range(self.size):
+            context = self._browser.new_context(**device)
+            if self.asset_cache is not None:
+                context.route("**/*", self.asset_cache.handler())
+            self._contexts.put(context)
+        self.pages_since_launch = 0
+        self.launch_count += 1
+
+    def _close_browser(self):
+        while not self._contexts.empty():
+            self._contexts.get_nowait()
+        if self._browser is not None:
+            try:
+                self._browser.close()
+            except Exception as e:
+                print(f"Error closing browser: {e}")
+            self._browser = None
+
+    def healthy(self) -> bool:
+        """Return False if the browser died or should be recycled."""
+        if self._browser is None or not self._browser.is_connected():
+            print("Browser is not connected")
+            return False
+        if self.pages_since_launch >= self.max_pages:
+            print(f"Browser rendered {self.pages_since_launch} pages, recycling")
+            return False
+        rss = _process_tree_rss_mb()
+        if rss > self.max_rss_mb:
+            print(f"Browser uses {rss:.0f} MB (limit {self.max_rss_mb} MB), recycling")
+            return False
+        return True
+
+    def recycle(self):
+        """Close the current browser and launch a fresh one."""
+        self._close_browser()
+        self._launch()
+
+    @contextmanager
+    def page(self):
+        """
+        Check out a fresh page from one of the pooled contexts.
+        The page is closed and its context returned to the pool afterwards.
+        """
+        self.start()
+        if not self.healthy():
+            self.recycle()
+        context = self._contexts.get()
+        try:
+            page = context.new_page()
+        except Exception:
+            # the context is gone with it: start() launches a fresh browser
+            # next time, instead of waiting forever for the context to return
+            self._close_browser()
+            raise
+        try:
+            yield page
+        finally:
+            self.pages_since_launch += 1
+            try:
+                page.close()
+                context.clear_cookies()
+            except Exception as e:
+                print(f"Error releasing page: {e}")
+            # contexts of a browser that was recycled meanwhile are dropped
+            if context.browser is self._browser:
+                self._contexts.put(context)
+
+
+def _load(page, url: str) -> tuple[int, int, float]:
+    """Open *url* and wait until it is ready. Returns CSS width, CSS height and device pixel ratio."""
+    with STAGE_SECONDS.time(stage="page_load"):
+        page.goto(url, wait_until="load")
+        wait_until_ready(page)
+    return (page.viewport_size["width"], page.evaluate("document.documentElement.scrollHeight"),
+            page.evaluate("window.devicePixelRatio"))
+
+
+def _capture(page, url: str, max_pixels: int | None = None) -> bytes:
+    print(f"Taking screenshot of {url}...")
+    css_width, css_height, ratio = _load(page, url)
+    pixels = round(css_width * ratio) * round(css_height * ratio)
+    if max_pixels and pixels > max_pixels:
+        raise PageTooLarge(f"{url} needs {pixels / 1e6:.0f} Mpx, the budget is {max_pixels / 1e6:.0f} Mpx")
+    print("Taking screenshot...")
+    with STAGE_SECONDS.time(stage="capture"):
+        png = page.screenshot(full_page=True)
+    print("Screenshot taken.")
+    return png
+
+
+def capture_page(url: str,
+                 device_name: str = "iPhone 12",
+                 pool: BrowserPool | None = None,
+                 archive_path: str | Path | None = None,
+                 max_pixels: int | None = None,
+                 width: int = 830) -> Image.Image:
     """
-    Resize the image at the given path to the specified width while maintaining the aspect ratio.
+    Render *url* in the chosen mobile device emulation and return the
+    full-page screenshot resized and rotated for the printer, without
+    touching the disk. The image is only written if *archive_path* is given.
+    If a *pool* is given its warm browser is used (and its device
+    emulation wins over *device_name*), otherwise a browser is
+    launched just for this screenshot.
+    Raises PageTooLarge before taking the screenshot if it would have more
+    than *max_pixels* pixels; capture_bands can split such pages.
     """
-    with Image.open(path) as img:
-        orig_width, orig_height = img.size
-        scale_factor = width / float(orig_width)
-        new_height = int(orig_height * scale_factor)
-        resized = img.resize((width, new_height))
-        return resized
+    if pool is None:
+        with BrowserPool(size=1, device_name=device_name) as own_pool:
+            with own_pool.page() as page:
+                png = _capture(page, url, max_pixels)
+    else:
+        with pool.page() as page:
+            png = _capture(page, url, max_pixels)
+
+    with Image.open(io.BytesIO(png)) as screenshot:
+        image = to_print_image(screenshot, width)
+    if archive_path is not None:
+        save_image(image, Path(archive_path).expanduser())
+    return image
+
+
+def screenshot_bands(url: str,
+                     band_height: int | None = 600,
+                     width: int = 830,
+                     pool: BrowserPool | None = None,
+                     max_pixels: int | None = None,
+                     split: bool = True):
+    """
+    The browser half of capture_bands: yield (png, rows) per band, bottom band
+    first, without decoding anything. *rows* is the band's height in print
+    rows. With *split* False a page that would need more than one band to
+    stay within *max_pixels* raises PageTooLarge instead.
+    """
+    with pool.page() as page:
+        print(f"Capturing {url}...")
+        css_width, css_height, ratio = _load(page, url)
+        scale = width / css_width
+        band_height = band_height or css_height
+        if max_pixels:
+            limit = max(1, int(max_pixels / (css_width * ratio * ratio)))
+            if limit < band_height and not split:
+                raise PageTooLarge(f"{url} is {css_height} px high, the budget allows {limit} px")
+            band_height = min(band_height, limit)
+
+        edges = list(range(0, css_height, band_height)) + [css_height]
+        bands = list(zip(edges, edges[1:]))
+        print(f"Page is {css_height} px high, {len(bands)} bands")
+        for top, bottom in reversed(bands):
+            rows = round(bottom * scale) - round(top * scale)
+            if rows <= 0:
+                continue
+            with STAGE_SECONDS.time(stage="capture"):
+                png = page.screenshot(full_page=True,
+                                      clip={"x": 0, "y": top, "width": css_width, "height": bottom - top})
+            yield png, rows
+
+
+def band_image(png: bytes, rows: int, width: int = 830) -> Image.Image:
+    """Decode a band from screenshot_bands, scale it to *width* if needed and rotate it by 180°."""
+    with STAGE_SECONDS.time(stage="resize"), Image.open(io.BytesIO(png)) as band:
+        if band.width != width:
+            band = band.resize((width, rows))
+        return band.rotate(180)
+
+
+def capture_bands(url: str,
+                  band_height: int | None = 600,
+                  width: int = 830,
+                  device_name: str = "iPhone 12",
+                  pool: BrowserPool | None = None,
+                  max_pixels: int | None = None):
+    """
+    Render *url* and yield it as horizontal bands of about *band_height* CSS px,
+    each resized to *width* and rotated by 180°, ready to be printed one after
+    the other. Only one band is held in memory at a time.
+    Without *band_height* the whole page is one band, unless that would
+    exceed *max_pixels*: bands are made small enough to stay within it.
+    Bands already rendered at *width* (see print_profile) are not resampled.
+
+    Since the printout is upside down, the bottom of the page has to come out
+    of the printer first: bands are captured from the bottom of the page
+    upwards. Band edges are mapped to print rows from the page top, so the
+    rounding of the individual bands adds up to exactly the full-page height.
+    """
+    if pool is None:
+        with BrowserPool(size=1, device_name=device_name) as own_pool:
+            yield from capture_bands(url, band_height, width, pool=own_pool, max_pixels=max_pixels)
+        return
+
+    for png, rows in screenshot_bands(url, band_height, width, pool, max_pixels):
+        yield band_image(png, rows, width)
 
 
 def full_page_screenshot(url: str,
                          path: str | Path = "screenshot.png",
-                         device_name: str = "iPhone 12") -> str:
+                         device_name: str = "iPhone 12",
+                         pool: BrowserPool | None = None) -> str:
     """
     Render *url* in the chosen mobile device emulation and
     save a scrolling / full-page PNG to *path*.
     Returns the absolute path of the screenshot.
     """
     path = Path(path).expanduser().resolve()
-
-    with sync_playwright() as p:
-        print("Launching browser...")
-        device = p.devices[device_name]          # iPhone, Pixel, Galaxy, …
-        browser = p.chromium.launch(headless=True)
-        context = browser.new_context(**device)
-        page = context.new_page()
-        print(f"Taking screenshot of {url} on {device_name}...")
-        page.goto(url, wait_until="networkidle")
-
-        # Scroll through the page once to trigger lazy-loaded elements
-        page.evaluate("""
-            (async () => {
-                const step = window.innerHeight;
-                for (let y = 0; y < document.body.scrollHeight; y += step) {
-                    window.scrollTo(0, y);
-                    await new Promise(r => setTimeout(r, 100));
-                }
-                window.scrollTo(0, 0);          // back to top for clean shot
-            })();
-        """)
-        print("Taking screenshot...")
-
-        page.screenshot(path=str(path), full_page=True)
-        browser.close()
-        print("Screenshot taken.") 
-        print("Resizing image...")
-        resized_img = resize_image(path, width=830)
-        rotated_img = resized_img.rotate(180)
-        rotated_img.save(path)
+    capture_page(url, device_name, pool, archive_path=path)
     return str(path)
 
 
@@ -1,23 +1,33 @@
 #!/usr/bin/env python
+"""Epson TM-T88IV, see printers.py. Every print job ends with a cut, feed() only advances the paper."""
 
-from escpos.printer import Usb
+from printers import get_backend
 
 
-VENDOR_ID = 0x04b8
-PRODUCT_ID = 0x0202
-PROFILE= "TM-T88IV"
+backend = get_backend("tm-t88iv")
 
-allowed_images = ['.jpg', '.gif', '.png', '.bmp']
+VENDOR_ID = backend.vendor_id
+PRODUCT_ID = backend.product_id
+PROFILE = backend.profile
 
-def print_image(filename):
-    p = Usb(VENDOR_ID, PRODUCT_ID, 0, profile=PROFILE)
-    assert filename.endswith(tuple(allowed_images)), "File type not supported"
-    p.image(filename)
-    p.cut()
-    p.close()
+def connect():
+    """Open the printer. Pass the handle as *printer* to keep it open across jobs."""
+    return backend.open()
 
-def print_text(text):
-    p = Usb(VENDOR_ID, PRODUCT_ID, 0, profile=PROFILE)
-    p.text(text)
-    p.cut()
-    p.close()
\ No newline at end of file
+def print_image(image, printer=None):
+    backend.print_image(image, printer=printer)
+
+def print_raster(rows, width_bytes, height, printer=None):
+    """Stream packed 1-bit rows (see raster.pack_image) to the printer as-is."""
+    backend.print_raster(rows, width_bytes, height, printer=printer)
+
+def print_commands(commands, printer=None):
+    """Send ready-made ESC/POS *commands* (see hybrid.render_html) to the printer."""
+    backend.print_commands(commands, cut=True, printer=printer)
+
+def feed(rows, printer=None):
+    """Advance the paper by *rows* dot rows, much cheaper than printing a blank image."""
+    backend.feed(rows, printer=printer)
+
+def print_text(text, printer=None):
+    backend.print_text(text, printer=printer)
@@ -0,0 +1,433 @@
+#!/usr/bin/env python
+"""
+Many newsletters, one event loop. FeedMonitor watches every subscription
+in a subscriptions file with a small asyncio IMAP client instead of a
+MailMonitor (two threads and a login) per feed: subscriptions that share an
+account and folder share one connection and one IDLE, and all of them
+deliver into the same queue the pipeline reads from.
+
+    {
+      "accounts": {
+        "home": {"host": "mail.example.com", "username": "xyz@example.com",
+                 "password_env": "PRNTI_MAIL_PASS"}
+      },
+      "subscriptions": [
+        {"name": "wnti", "account": "home", "senders": ["redaktion@wnti.ch"]},
+        {"name": "other", "account": "home", "folder": "Newsletters",
+         "senders": ["news@example.org", "digest@example.org"],
+         "url_pattern": "https://example\\\\.org/issues/[0-9]+"}
+      ]
+    }
+
+Without "url_pattern" the wnti Mailchimp pattern is used. Passwords are read
+from the environment variable named in "password_env" ("password" works too).
+
+`python feeds.py subscriptions.json` prints every article URL as it arrives.
+"""
+
+from mailbox import (ARTICLE_URL_PATTERN, HEADER_FIELDS, MailSummary, _parse_imap, _parse_summary,
+                     _read_text, extract_article_url)
+from metrics import STAGE_SECONDS
+from argparse import ArgumentParser
+from dataclasses import dataclass
+from typing import Optional
+import asyncio
+import itertools
+import json
+import os
+import queue
+import re
+import socket
+import ssl as ssl_module
+import threading
+import time
+
+
+@dataclass(frozen=True)
+class Subscription:
+    """One newsletter: where it arrives, who sends it and how to find its article link."""
+    name: str
+    host: str
+    username: str
+    password: str
+    senders: tuple[str, ...]
+    folder: str = 'INBOX'
+    url_pattern: str = ARTICLE_URL_PATTERN
+    port: Optional[int] = None
+    ssl: bool = True
+
+    @property
+    def mailbox(self) -> tuple:
+        """Subscriptions with the same mailbox share a connection."""
+        return self.host, self.port, self.username, self.folder
+
+    def matches(self, from_: str) -> bool:
+        return any(sender.lower() in from_.lower() for sender in self.senders)
+
+
+def load_subscriptions(path: str) -> list[Subscription]:
+    """Read a subscriptions file, see the module docstring for its format."""
+    with open(path) as f:
+        config = json.load(f)
+    accounts = config.get("accounts", {})
+    subscriptions = []
+    for entry in config["subscriptions"]:
+        account = dict(accounts[entry["account"]]) if "account" in entry else {}
+        account.update({k: v for k, v in entry.items() if k != "account"})
+        if "password_env" in account:
+            account["password"] = os.getenv(account.pop("password_env"), "")
+        senders = account.pop("senders", None) or [account.pop("sender")]
+        re.compile(account.get("url_pattern", ARTICLE_URL_PATTERN))  # fail at startup, not per mail
+        subscriptions.append(Subscription(senders=tuple(senders), **account))
+    return subscriptions
+
+
+class ImapError(Exception):
+    """The server answered NO or BAD."""
+
+
+def _quote(value: str) -> str:
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+class AsyncImapClient:
+    """
+    Just enough IMAP4rev1 for FeedMonitor, on asyncio streams. Every read has
+    a *timeout*, so a connection that silently died raises instead of
+    hanging: there is nothing to watchdog.
+    """
+
+    def __init__(self, host: str, port: Optional[int] = None, ssl: bool = True, timeout: float = 60):
+        self.host = host
+        self.port = port or (993 if ssl else 143)
+        self.ssl = ssl
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self.tags = itertools.count(1)
+        self.exists = False  # the server announced new mail (* n EXISTS) outside of IDLE
+
+    async def connect(self):
+        context = ssl_module.create_default_context() if self.ssl else None
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=context, limit=2 ** 20), self.timeout)
+        sock = self.writer.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        await self._response()  # greeting
+
+    async def _response(self, timeout: Optional[float] = None) -> bytes:
+        """Read one response line, with any {n} literals it announces."""
+        line = await asyncio.wait_for(self.reader.readline(), timeout or self.timeout)
+        if not line:
+            raise ConnectionError("IMAP server closed the connection")
+        while (literal := re.search(rb'\{(\d+)\}\r\n$', line)):
+            line += await asyncio.wait_for(self.reader.readexactly(int(literal.group(1))), self.timeout)
+            line += await asyncio.wait_for(self.reader.readline(), self.timeout)
+        return line
+
+    async def command(self, command: str) -> list[bytes]:
+        """Send *command* and return its untagged responses, raise ImapError unless it is OK."""
+        tag = f"P{next(self.tags):04d}".encode()
+        self.writer.write(tag + b" " + command.encode() + b"\r\n")
+        await self.writer.drain()
+        untagged = []
+        while True:
+            line = await self._response()
+            if line.startswith(tag + b" "):
+                status = line[len(tag) + 1:].split(b" ", 1)[0]
+                if status.upper() != b"OK":
+                    raise ImapError(f"{command.split(' ')[0]}: {line.decode(errors='replace').strip()}")
+                return untagged
+            if re.match(rb'\* \d+ EXISTS', line):
+                self.exists = True
+            untagged.append(line)
+
+    async def login(self, username: str, password: str):
+        await self.command(f"LOGIN {_quote(username)} {_quote(password)}")
+
+    async def select(self, folder: str) -> Optional[str]:
+        """Select *folder* and return its UIDVALIDITY."""
+        for line in await self.command(f"SELECT {_quote(folder)}"):
+            match = re.search(rb'\[UIDVALIDITY (\d+)\]', line)
+            if match:
+                return match.group(1).decode()
+        return None
+
+    async def uid_search(self, criteria: str) -> list[int]:
+        uids = []
+        for line in await self.command(f"UID SEARCH {criteria}"):
+            if line.upper().startswith(b"* SEARCH"):
+                uids += [int(uid) for uid in line.split()[2:]]
+        return uids
+
+    async def uid_fetch(self, uids, items: str) -> list[dict]:
+        """One {ITEM: value} dict per message, like mailbox._fetch_items."""
+        messages = []
+        for line in await self.command(f"UID FETCH {','.join(map(str, uids))} {items}"):
+            tokens = _parse_imap(line)
+            if len(tokens) == 4 and tokens[2].upper() == b"FETCH" and isinstance(tokens[3], list):
+                data = tokens[3]
+                keys = [k.decode().upper() if isinstance(k, bytes) else k for k in data[::2]]
+                messages.append(dict(zip(keys, data[1::2])))
+        return messages
+
+    async def uid_store(self, uids, flags: str):
+        await self.command(f"UID STORE {','.join(map(str, uids))} +FLAGS.SILENT ({flags})")
+
+    async def idle(self, timeout: float) -> bool:
+        """
+        IDLE for at most *timeout* seconds. Returns True as soon as the server
+        reports new mail, False if the time ran out.
+        """
+        tag = f"P{next(self.tags):04d}".encode()
+        self.writer.write(tag + b" IDLE\r\n")
+        await self.writer.drain()
+        line = await self._response()
+        if not line.startswith(b"+"):
+            raise ImapError(f"IDLE: {line.decode(errors='replace').strip()}")
+        news = False
+        end = time.monotonic() + timeout
+        try:
+            while (remaining := end - time.monotonic()) > 0:
+                try:
+                    line = await self._response(remaining)
+                except asyncio.TimeoutError:
+                    break
+                if re.match(rb'\* \d+ (EXISTS|RECENT)', line):
+                    news = True
+                    break
+        finally:
+            # skipped when cancelled, the connection is dropped then anyway
+            self.writer.write(b"DONE\r\n")
+        await self.writer.drain()
+        while not (await self._response()).startswith(tag + b" "):
+            pass
+        return news
+
+    async def logout(self):
+        if self.writer is None:
+            return
+        try:
+            await asyncio.wait_for(self.command("LOGOUT"), 5)
+        except Exception:
+            pass
+        self.writer.close()
+        self.writer = self.reader = None
+
+
+class FeedState:
+    """The UID mark of every watched folder, in one JSON file (MailSession keeps one per file)."""
+
+    def __init__(self, path: str = 'feeds_state.json'):
+        self.path = path
+        try:
+            with open(path) as f:
+                self.folders = json.load(f)
+        except (OSError, ValueError):
+            self.folders = {}
+
+    def get(self, key: str) -> dict:
+        return self.folders.setdefault(key, {"uidvalidity": None, "last_uid": 0})
+
+    def save(self):
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.folders, f, indent=1)
+        os.replace(tmp, self.path)
+
+
+class FolderWatch:
+    """The subscriptions of one account and folder, on one connection."""
+
+    def __init__(self, subscriptions: list[Subscription], state: FeedState, deliver,
+                 idle_refresh: int = 25 * 60, timeout: float = 60):
+        self.subscriptions = subscriptions
+        first = subscriptions[0]
+        self.first = first
+        self.key = f"{first.username}@{first.host}/{first.folder}"
+        self.senders = sorted({s for sub in subscriptions for s in sub.senders})
+        self.state = state
+        self.deliver = deliver
+        self.idle_refresh = idle_refresh
+        self.timeout = timeout
+        self.client = None
+        self.connected = asyncio.Event()
+        self.restart_count = 0
+
+    async def _connect(self):
+        print(f"Connecting to {self.key} for {', '.join(s.name for s in self.subscriptions)}")
+        self.client = AsyncImapClient(self.first.host, self.first.port, self.first.ssl, self.timeout)
+        await self.client.connect()
+        await self.client.login(self.first.username, self.first.password)
+        uidvalidity = await self.client.select(self.first.folder)
+        mark = self.state.get(self.key)
+        if uidvalidity != mark["uidvalidity"]:
+            print(f"{self.key}: UIDVALIDITY changed ({mark['uidvalidity']} -> {uidvalidity}), resetting UID mark")
+            mark.update(uidvalidity=uidvalidity, last_uid=0)
+            self.state.save()
+        self.connected.set()
+
+    async def _fetch_text(self, msg: MailSummary, structure: list):
+        """Download the text part of *msg* over this connection, see mailbox._read_text."""
+        reader = _read_text(msg, structure)
+        try:
+            items = next(reader)
+            while True:
+                items = reader.send(await self.client.uid_fetch([msg.uid], items))
+        except StopIteration:
+            pass
+
+    async def catch_up(self) -> int:
+        """Deliver unseen mail from any subscribed sender above the UID mark, oldest first."""
+        mark = self.state.get(self.key)
+        with STAGE_SECONDS.time(stage="imap_fetch"):
+            uids = set()
+            for sender in self.senders:
+                uids.update(await self.client.uid_search(
+                    f"UID {mark['last_uid'] + 1}:* FROM {_quote(sender)} UNSEEN"))
+            uids = sorted(uid for uid in uids if uid > mark["last_uid"])
+            if not uids:
+                return 0
+            msgs = []
+            for item in await self.client.uid_fetch(uids, f'(UID BODYSTRUCTURE BODY.PEEK[{HEADER_FIELDS}])'):
+                msg = _parse_summary(item)
+                subscription = next((s for s in self.subscriptions if s.matches(msg.from_)), None)
+                if subscription is None:
+                    print(f"Skipping mail from {msg.from_}")
+                    continue
+                msg.feed, msg.url_pattern = subscription.name, subscription.url_pattern
+                await self._fetch_text(msg, item.get('BODYSTRUCTURE') or [])
+                msgs.append(msg)
+            await self.client.uid_store(uids, "\\Seen")
+        mark["last_uid"] = max(uids)
+        self.state.save()
+        for msg in sorted(msgs, key=lambda msg: msg.date.timestamp()):
+            print(f"[{msg.feed}] Found unseen message: '{msg.subject}' from {msg.from_} (UID: {msg.uid})")
+            self.deliver(msg)
+        return len(msgs)
+
+    async def run(self):
+        """Catch up, IDLE, repeat; reconnect with back-off whenever the connection breaks."""
+        failures = 0
+        while True:
+            try:
+                if self.client is None:
+                    await self._connect()
+                    failures = 0
+                # mail that arrives while catching up is only announced in
+                # the responses to our commands, IDLE would not report it
+                self.client.exists = False
+                await self.catch_up()
+                while self.client.exists:
+                    self.client.exists = False
+                    await self.catch_up()
+                waiting_since = time.time()
+                if await self.client.idle(self.idle_refresh):
+                    STAGE_SECONDS.observe(time.time() - waiting_since, stage="imap_wait")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                failures += 1
+                self.restart_count += 1
+                delay = min(300, 5 * 2 ** (failures - 1))
+                print(f"Error watching {self.key}: {e!r}, reconnecting in {delay}s")
+                await self.close()
+                await asyncio.sleep(delay)
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.logout()
+            self.client = None
+
+
+class FeedMonitor:
+    """
+    Watch all *subscriptions* on one asyncio loop in one thread.
+
+    Has MailMonitor's interface (start, stop, get_message, get_restart_count,
+    connected), so the pipeline does not care which one it reads from. The
+    messages carry their subscription's name and URL pattern, extract_article_url
+    picks the pattern up from there.
+    """
+
+    def __init__(self, subscriptions: list[Subscription], state_path: str = 'feeds_state.json',
+                 idle_refresh: int = 25 * 60, timeout: float = 60):
+        self.subscriptions = subscriptions
+        self.state = FeedState(state_path)
+        self.idle_refresh = idle_refresh
+        self.timeout = timeout
+        self.mail_queue = queue.Queue()
+        self.connected = threading.Event()  # set once every folder has logged in
+        self.watches = []
+        self.loop = None
+        self.thread = None
+        self._stop = None
+        self._started = threading.Event()
+
+    async def _main(self):
+        self.loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        self._started.set()
+        groups = {}
+        for subscription in self.subscriptions:
+            groups.setdefault(subscription.mailbox, []).append(subscription)
+        self.watches = [FolderWatch(subs, self.state, self.mail_queue.put, self.idle_refresh, self.timeout)
+                        for subs in groups.values()]
+        print(f"Watching {len(self.subscriptions)} subscription(s) in {len(self.watches)} folder(s)")
+        tasks = [asyncio.create_task(watch.run()) for watch in self.watches]
+
+        async def all_connected():
+            await asyncio.gather(*(watch.connected.wait() for watch in self.watches))
+            self.connected.set()
+
+        tasks.append(asyncio.create_task(all_connected()))
+        await self._stop.wait()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.gather(*(watch.close() for watch in self.watches), return_exceptions=True)
+
+    def start(self):
+        print("Starting FeedMonitor...")
+        self.thread = threading.Thread(target=lambda: asyncio.run(self._main()), daemon=True)
+        self.thread.start()
+        self._started.wait()
+        return self
+
+    def stop(self):
+        print("Stopping FeedMonitor...")
+        if self.loop is not None and self.thread.is_alive():
+            self.loop.call_soon_threadsafe(self._stop.set)
+            self.thread.join(timeout=10)
+        print("FeedMonitor stopped")
+
+    def get_message(self, timeout: Optional[float] = None) -> Optional[MailSummary]:
+        """Get the next message of any subscription, None if *timeout* is reached."""
+        try:
+            return self.mail_queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def get_restart_count(self) -> int:
+        """Reconnects over all folders."""
+        return sum(watch.restart_count for watch in self.watches)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Watch the subscriptions in a file and print their article URLs.")
+    parser.add_argument("subscriptions", help="Subscriptions file (JSON)")
+    parser.add_argument("-s", "--state", default="feeds_state.json", help="UID marks (default: feeds_state.json)")
+    args = parser.parse_args()
+
+    from dotenv import load_dotenv
+    load_dotenv()
+    monitor = FeedMonitor(load_subscriptions(args.subscriptions), args.state).start()
+    try:
+        while True:
+            msg = monitor.get_message()
+            print(f"[{msg.feed}] {msg.subject}: {extract_article_url(msg)}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        monitor.stop()
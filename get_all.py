@@ -2,17 +2,333 @@
 
 from icecream import ic
 from csv import DictReader
-from browser import full_page_screenshot
+from browser import (MAX_PIXELS, READY_SCRIPT, READY_TIMEOUT, PageTooLarge, print_profile,
+                     to_print_image, save_image)
+from assets import AssetCache
+from PIL import Image
+from archive import RasterArchive
+from hybrid import USER_AGENT
+from store import NewsletterStore, html_hash
+from playwright.async_api import async_playwright
 from tqdm import tqdm
+from argparse import ArgumentParser
+from collections import Counter
+from pathlib import Path
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+import asyncio
+import io
+import json
 import os
+import time
 
 
-newsletters=DictReader(open("newsletters.csv"))
+PROGRESS_FILE = "newsletters/.progress.json"
+VALIDATORS_DB = "newsletters/validators.db"
 
-for newsletter in tqdm(newsletters):
-    if newsletter["url"]!='':
-        ic(newsletter)
-        path=f"newsletters/{newsletter['id']}.jpg"
+
+def load_progress(path: str) -> dict:
+    """Load the progress file of an earlier (possibly interrupted) run."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"done": [], "failed": {}}
+
+
+def save_progress(path: str, progress: dict):
+    """Write the progress file atomically so an interrupted run can resume."""
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(progress, f, indent=2)
+    os.replace(tmp, path)
+
+
+def check(url: str, validators: dict | None, timeout: float = 30) -> tuple[str, dict]:
+    """
+    Find out with one conditional GET whether *url* changed since the version
+    described by *validators* (see NewsletterStore.get_validators) was rendered.
+    Returns the status and the validators of the current version; the status is
+        not_modified: the server answered 304, nothing was downloaded
+        same:         the HTML differs at most in volatile parts (see store.normalise_html)
+        changed:      the content changed
+        new:          there was nothing to compare with
+    """
+    fields = ("etag", "last_modified", "html_hash")
+    headers = {"User-Agent": USER_AGENT}
+    if validators and validators["etag"]:
+        headers["If-None-Match"] = validators["etag"]
+    if validators and validators["last_modified"]:
+        headers["If-Modified-Since"] = validators["last_modified"]
+    try:
+        with urlopen(Request(url, headers=headers), timeout=timeout) as response:
+            body = response.read()
+            current = {"etag": response.headers.get("ETag"),
+                       "last_modified": response.headers.get("Last-Modified")}
+    except HTTPError as e:
+        if e.code == 304 and validators:
+            return "not_modified", {k: validators[k] for k in fields}
+        raise
+    current["html_hash"] = html_hash(body.decode("utf-8", "replace"))
+    if not validators or not validators["html_hash"]:
+        return "new", current
+    return ("same" if current["html_hash"] == validators["html_hash"] else "changed"), current
+
+
+async def revalidate(newsletters: list[dict], store: NewsletterStore, concurrency: int = 8,
+                     timeout: float = 30) -> dict[str, tuple[str, dict | None]]:
+    """Run check() for all *newsletters*, *concurrency* at a time. Returns {id: (status, validators)}."""
+    limit = asyncio.Semaphore(concurrency)
+
+    async def one(newsletter):
+        async with limit:
+            try:
+                result = await asyncio.to_thread(check, newsletter["url"],
+                                                 store.get_validators(newsletter["url"]), timeout)
+            except Exception as e:
+                print(f"{newsletter['id']}: could not revalidate ({e!r})")
+                result = ("error", None)
+        return newsletter["id"], result
+
+    return dict(await asyncio.gather(*(one(n) for n in newsletters)))
+
+
+async def capture(context, url: str, timeout: float, max_pixels: int | None = MAX_PIXELS,
+                  split: bool = False) -> tuple[list[bytes], dict | None]:
+    """
+    Render *url* in a fresh page of *context* and return it as PNG screenshots,
+    with the validators of the HTML the browser loaded (as check() returns them).
+    A page within *max_pixels* is one full-page screenshot. A longer one is
+    captured in bands that each fit the budget, bottom band first like
+    browser.screenshot_bands, if *split* is set, otherwise PageTooLarge is
+    raised before anything is captured.
+    """
+    page = await context.new_page()
+    try:
+        response = await page.goto(url, wait_until="load", timeout=timeout * 1000)
+        validators = None
+        if response is not None:
+            # the document as served, page.content() would be the DOM after scripts ran
+            body = await response.body()
+            validators = {"etag": response.headers.get("etag"),
+                          "last_modified": response.headers.get("last-modified"),
+                          "html_hash": html_hash(body.decode("utf-8", "replace"))}
+        await page.evaluate(READY_SCRIPT, READY_TIMEOUT)
+        css_width = page.viewport_size["width"]
+        css_height = await page.evaluate("document.documentElement.scrollHeight")
+        ratio = await page.evaluate("window.devicePixelRatio")
+        limit = css_height
+        if max_pixels:
+            limit = max(1, int(max_pixels / (css_width * ratio * ratio)))
+        if limit >= css_height:
+            return [await page.screenshot(full_page=True, timeout=timeout * 1000)], validators
+        if not split:
+            raise PageTooLarge(f"{url} is {css_height} px high, the budget allows {limit} px")
+        bands = []
+        for top in reversed(range(0, css_height, limit)):
+            clip = {"x": 0, "y": top, "width": css_width, "height": min(limit, css_height - top)}
+            bands.append(await page.screenshot(full_page=True, clip=clip, timeout=timeout * 1000))
+        return bands, validators
+    finally:
+        await page.close()
+
+
+def save_screenshot(pngs: list[bytes], part: Path, path: Path, archive: RasterArchive | None = None,
+                    key: str = ""):
+    """
+    Resize and rotate the screenshot in memory and move it into place at *path*,
+    or pack it into *archive* under *key* if one is given. Bands (see capture)
+    only go into the archive, packed one at a time and stored as one entry.
+    """
+    if archive is not None:
+        from raster import pack_image
+        rows = []
+        for png in pngs:
+            with Image.open(io.BytesIO(png)) as screenshot:
+                packed, width_bytes, _ = pack_image(to_print_image(screenshot))
+            rows.append(packed)
+        rows = b"".join(rows)
+        archive.add_rows(key, rows, width_bytes, len(rows) // width_bytes)
+        return
+    png, = pngs
+    with Image.open(io.BytesIO(png)) as screenshot:
+        image = to_print_image(screenshot)
+    save_image(image, part)
+    os.replace(part, path)
+
+
+async def get_newsletter(contexts: asyncio.Queue, newsletter: dict, path: Path,
+                         timeout: float, retries: int, backoff: float,
+                         archive: RasterArchive | None = None, max_pixels: int | None = MAX_PIXELS):
+    """
+    Screenshot one newsletter with a hard per-URL timeout and retry with
+    exponential backoff. The JPG is written next to *path* first and
+    only moved into place once it is complete, so the skip-if-exists check
+    never mistakes a half-written file for a finished one.
+    Pages above *max_pixels* are captured in bands into the *archive*;
+    without one they fail with PageTooLarge, a JPG would need the whole page.
+    Returns the page's validators, see capture.
+    """
+    part = path.with_suffix(".part" + path.suffix)
+    for attempt in range(retries + 1):
+        context = await contexts.get()
+        try:
+            pngs, validators = await asyncio.wait_for(
+                capture(context, newsletter["url"], timeout, max_pixels, split=archive is not None), timeout)
+            await asyncio.to_thread(save_screenshot, pngs, part, path, archive, newsletter["id"])
+            return validators
+        except PageTooLarge:
+            raise  # it will not get any smaller
+        except Exception as e:
+            if attempt == retries:
+                part.unlink(missing_ok=True)
+                raise
+            delay = backoff * 2 ** attempt
+            print(f"{newsletter['id']}: attempt {attempt + 1} failed ({e!r}), retrying in {delay:.0f}s")
+        finally:
+            contexts.put_nowait(context)
+        await asyncio.sleep(delay)
+
+
+async def get_all(newsletters: list[dict], concurrency: int = 3, timeout: float = 90,
+                  retries: int = 2, backoff: float = 5, progress_file: str = PROGRESS_FILE,
+                  retry_failed: bool = False, device_name: str = "iPhone 12",
+                  archive: RasterArchive | None = None, asset_cache: AssetCache | None = None,
+                  store: NewsletterStore | None = None, refresh: bool = False,
+                  max_pixels: int | None = MAX_PIXELS):
+    """
+    Screenshot all *newsletters* with at most *concurrency* pages in flight.
+    Newsletters whose JPG already exists (or that are already in *archive*,
+    if one is given) are skipped, as are the ones that failed in an earlier
+    run unless *retry_failed* is set. With an *asset_cache* trackers are
+    blocked and images, fonts and stylesheets shared between newsletters are
+    downloaded only once.
+    With a *store* the validators of every rendered newsletter are recorded,
+    from the browser's own page load; *refresh* then revalidates the existing ones with cheap conditional
+    requests and renders only those whose content changed.
+    Screenshots are capped at *max_pixels*, see get_newsletter.
+    """
+    progress = load_progress(progress_file)
+    done = set(progress["done"])
+    failed = progress["failed"]
+
+    todo = []
+    existing = []
+    for newsletter in newsletters:
+        if newsletter["url"] == '':
+            continue
+        path = Path(f"newsletters/{newsletter['id']}.jpg")
         # does path exist?
-        if not os.path.isfile(path):
-            full_page_screenshot(newsletter["url"],path)
+        if archive is not None:
+            exists = newsletter["id"] in archive
+        else:
+            exists = os.path.isfile(path)
+        if exists:
+            done.add(newsletter["id"])
+            if refresh:
+                existing.append((newsletter, path))
+            continue
+        if newsletter["id"] in failed and not retry_failed:
+            continue
+        todo.append((newsletter, path))
+
+    avoided = 0
+    if store is not None and existing:
+        checks = await revalidate([n for n, _ in existing], store)
+        statuses = Counter()
+        for newsletter, path in existing:
+            status, current = checks[newsletter["id"]]
+            statuses[status] += 1
+            if status == "changed":
+                todo.append((newsletter, path))
+            elif current is not None:
+                # unchanged, or a baseline for the next refresh of an older render
+                store.set_validators(newsletter["url"], **current)
+        avoided = statuses["not_modified"] + statuses["same"]
+        print(f"Revalidated {len(existing)} rendered newsletters: {statuses['not_modified']} not modified, "
+              f"{statuses['same']} same content, {statuses['changed']} changed, "
+              f"{statuses['new']} without validators, {statuses['error']} errors; "
+              f"{avoided} re-renders avoided")
+
+    print(f"{len(todo)} newsletters to render, {len(done)} already done, {len(failed)} failed before")
+    if not todo:
+        return
+
+    start = time.time()
+    rendered = 0
+    async with async_playwright() as p:
+        # render at print width, the screenshots then need no resampling
+        device = print_profile(p.devices[device_name], 830)
+        browser = await p.chromium.launch(headless=True)
+        contexts = asyncio.Queue()
+        for _ in range(min(concurrency, len(todo))):
+            context = await browser.new_context(**device)
+            if asset_cache is not None:
+                await context.route("**/*", asset_cache.async_handler())
+            contexts.put_nowait(context)
+
+        async def worker(newsletter, path):
+            ic(newsletter)
+            try:
+                validators = await get_newsletter(contexts, newsletter, path, timeout, retries, backoff,
+                                                  archive, max_pixels)
+            except Exception as e:
+                failed[newsletter["id"]] = repr(e)
+                print(f"{newsletter['id']}: giving up ({e!r})")
+            else:
+                failed.pop(newsletter["id"], None)
+                done.add(newsletter["id"])
+                if store is not None and validators is not None:
+                    store.set_validators(newsletter["url"], **validators)
+                return True
+            finally:
+                progress["done"] = sorted(done)
+                save_progress(progress_file, progress)
+                pbar.update()
+            return False
+
+        with tqdm(total=len(todo)) as pbar:
+            results = await asyncio.gather(*(worker(n, path) for n, path in todo))
+        rendered = sum(results)
+        await browser.close()
+
+    elapsed = time.time() - start
+    print(f"Rendered {rendered}/{len(todo)} newsletters in {elapsed:.0f}s "
+          f"({rendered / elapsed * 60:.1f} pages/min), {len(failed)} failed"
+          + (f", {avoided} re-renders avoided" if refresh else ""))
+    if asset_cache is not None:
+        print(f"Assets: {asset_cache.stats()}")
+
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser(description="Screenshot every newsletter in newsletters.csv.")
+    parser.add_argument("-c", "--concurrency", type=int, default=3,
+                        help="Number of pages rendered at the same time (default: 3)")
+    parser.add_argument("-t", "--timeout", type=float, default=90,
+                        help="Timeout per newsletter in seconds (default: 90)")
+    parser.add_argument("-r", "--retries", type=int, default=2,
+                        help="Retries per newsletter (default: 2)")
+    parser.add_argument("--retry-failed", action="store_true",
+                        help="Also retry newsletters that failed in an earlier run")
+    parser.add_argument("-a", "--archive", action="store_true",
+                        help="Write into the packed raster archive instead of JPGs")
+    parser.add_argument("--no-asset-cache", action="store_true",
+                        help="Download every asset again and don't block trackers")
+    parser.add_argument("--refresh", action="store_true",
+                        help="Check already rendered newsletters with conditional requests "
+                             "and render again the ones that changed")
+    args = parser.parse_args()
+
+    os.makedirs("newsletters", exist_ok=True)
+    newsletters = list(DictReader(open("newsletters.csv")))
+    archive = RasterArchive("newsletters") if args.archive else None
+    asset_cache = None if args.no_asset_cache else AssetCache()
+    store = NewsletterStore(VALIDATORS_DB)
+    max_pixels = int(os.getenv("PRNTI_MAX_PIXELS") or 0) or MAX_PIXELS
+    try:
+        asyncio.run(get_all(newsletters, args.concurrency, args.timeout, args.retries,
+                            retry_failed=args.retry_failed, archive=archive, asset_cache=asset_cache,
+                            store=store, refresh=args.refresh, max_pixels=max_pixels))
+    finally:
+        store.close()
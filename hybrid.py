@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+"""
+Hybrid rendering: article text goes to the printer as native ESC/POS text,
+only the pictures are rasterised. A mostly-text newsletter becomes a few
+kilobytes instead of megabytes of GS v 0 rows, and the printer's built-in
+font is faster than any bitmap.
+
+Like the raster modes, the printout comes out upside down (bottom of the
+article first, upside-down character mode), so it reads the right way round
+when it hangs from the printer.
+"""
+
+from assets import is_tracker
+from html.parser import HTMLParser
+from metrics import STAGE_SECONDS
+from raster import GAMMA, pack_image, raster_commands
+from urllib.parse import urljoin
+from urllib.request import Request, urlopen
+from argparse import ArgumentParser
+from PIL import Image
+import io
+
+
+USER_AGENT = ("Mozilla/5.0 (iPhone; CPU iPhone OS 14_4 like Mac OS X) "
+              "AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.0.3 Mobile/15E148 Safari/604.1")
+
+# Font A is 12 dots wide, the 830 dot line fits 69 characters
+CHAR_WIDTH = 12
+
+ESC_INIT_CODEPAGE = b"\x1bt\x00"  # PC437
+ESC_UPSIDE_DOWN = b"\x1b{\x01"
+ESC_UPRIGHT = b"\x1b{\x00"
+ESC_BOLD = (b"\x1bE\x00", b"\x1bE\x01")
+GS_SIZE = (b"\x1d!\x00", b"\x1d!\x11")  # normal, double width and height
+
+BLOCK_TAGS = {"p", "div", "section", "article", "table", "tr", "td", "ul", "ol", "li",
+              "blockquote", "h1", "h2", "h3", "h4", "h5", "h6", "br", "hr"}
+BOLD_TAGS = {"b", "strong", "h1", "h2", "h3", "h4"}
+LARGE_TAGS = {"h1", "h2"}
+SKIP_TAGS = {"head", "script", "style", "noscript", "title", "svg", "template"}
+VOID_TAGS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta",
+             "source", "track", "wbr"}
+
+# typography cp437 has no glyphs for
+_ASCII = str.maketrans({"\u2018": "'", "\u2019": "'", "\u201a": "'", "\u201c": '"', "\u201d": '"',
+                        "\u201e": '"', "\u00ab": '"', "\u00bb": '"', "\u2013": "-", "\u2014": "-",
+                        "\u2026": "...", "\u200b": "", "\u00ad": ""})
+
+
+class ArticleParser(HTMLParser):
+    """
+    Flatten article HTML into blocks, top to bottom:
+        ("text", [(word, bold, large), ...])
+        ("image", url)
+        ("rule", None)
+    Hidden elements (display:none, Mailchimp's preheader), scripts, styles and
+    tracking pixels are dropped.
+    """
+
+    def __init__(self, base_url: str = ""):
+        super().__init__(convert_charrefs=True)
+        self.base_url = base_url
+        self.blocks = []
+        self.words = []
+        self.bold = 0
+        self.large = 0
+        self.skipping = []  # open tags inside a skipped element
+        self.prefix = ""
+
+    def _flush(self):
+        if self.words:
+            self.blocks.append(("text", self.words))
+            self.words = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if self.skipping:
+            if tag not in VOID_TAGS:
+                self.skipping.append(tag)
+            return
+        style = (attrs.get("style") or "").replace(" ", "").lower()
+        if tag in SKIP_TAGS or "display:none" in style:
+            if tag not in VOID_TAGS:
+                self.skipping.append(tag)
+            return
+        if tag in BLOCK_TAGS:
+            self._flush()
+        if tag == "hr":
+            self.blocks.append(("rule", None))
+        elif tag == "li":
+            self.prefix = "- "
+        elif tag == "img":
+            self._image(attrs)
+        if tag in VOID_TAGS:
+            return
+        self.bold += tag in BOLD_TAGS
+        self.large += tag in LARGE_TAGS
+
+    def handle_endtag(self, tag):
+        if self.skipping:
+            # unwind to the matching tag, optional end tags like </p> are often left out
+            if tag in self.skipping:
+                depth = len(self.skipping) - 1 - self.skipping[::-1].index(tag)
+                del self.skipping[depth:]
+            return
+        if tag in BLOCK_TAGS:
+            self._flush()
+        if tag in BOLD_TAGS and self.bold:
+            self.bold -= 1
+        if tag in LARGE_TAGS and self.large:
+            self.large -= 1
+
+    def handle_data(self, data):
+        if self.skipping:
+            return
+        for word in data.translate(_ASCII).split():
+            if self.prefix:
+                word, self.prefix = self.prefix + word, ""
+            self.words.append((word, self.bold > 0, self.large > 0))
+
+    def _image(self, attrs):
+        src = attrs.get("src")
+        if not src or src.startswith("data:"):
+            return
+        url = urljoin(self.base_url, src)
+        sizes = [attrs.get("width", ""), attrs.get("height", "")]
+        if is_tracker(url) or any(s.isdigit() and int(s) <= 2 for s in sizes):
+            return
+        self._flush()
+        self.blocks.append(("image", url))
+
+    def close(self):
+        super().close()
+        self._flush()
+
+
+def wrap(words: list[tuple], columns: int) -> list[list[tuple]]:
+    """
+    Break styled *words* into lines of at most *columns* characters
+    (large words count double). Each line is a list of (text, bold, large)
+    runs with consecutive words of the same style merged.
+    """
+    lines, line, used = [], [], 0
+    for word, bold, large in words:
+        width = len(word) * (2 if large else 1)
+        if line and used + 1 + width > columns:
+            lines.append(line)
+            line, used = [], 0
+        if line:
+            used += 1
+            text, b, l = line[-1]
+            if (b, l) == (bold, large):
+                line[-1] = (f"{text} {word}", b, l)
+                used += width
+                continue
+            line[-1] = (text + " ", b, l)
+        line.append((word, bold, large))
+        used += width
+    if line:
+        lines.append(line)
+    return lines
+
+
+def _line_command(runs: list[tuple]) -> bytes:
+    out = b""
+    for text, bold, large in runs:
+        out += ESC_BOLD[bold] + GS_SIZE[large] + text.encode("cp437", "replace")
+    return out + ESC_BOLD[0] + GS_SIZE[0] + b"\n"
+
+
+def fetch(url: str, asset_cache=None, timeout: float = 30) -> bytes:
+    """GET *url*, through the asset cache if one is given."""
+    if asset_cache is not None:
+        cached = asset_cache.get(url)
+        if cached is not None:
+            return cached[0]
+    with urlopen(Request(url, headers={"User-Agent": USER_AGENT}), timeout=timeout) as response:
+        body = response.read()
+        content_type = response.headers.get("content-type")
+    if asset_cache is not None and (content_type or "").startswith("image/"):
+        asset_cache.put(url, body, content_type)
+    return body
+
+
+def _image_commands(url: str, width: int, asset_cache=None,
+                    dither: str = "diffusion", gamma: float = GAMMA) -> list[bytes]:
+    try:
+        with Image.open(io.BytesIO(fetch(url, asset_cache))) as image:
+            image = image.convert("RGB")
+    except Exception as e:
+        print(f"Skipping image {url}: {e}")
+        return []
+    if image.width > width:
+        image = image.resize((width, round(image.height * width / image.width)))
+    # centre it, the printer would put a narrow image on its left edge,
+    # which is the reader's right once the paper is turned round
+    canvas = Image.new("RGB", (width, image.height), "white")
+    canvas.paste(image, ((width - image.width) // 2, 0))
+    return list(raster_commands(*pack_image(canvas.rotate(180), dither, gamma)))
+
+
+def render_html(html: str, base_url: str = "", width: int = 830, asset_cache=None,
+                dither: str = "diffusion", gamma: float = GAMMA) -> list[bytes]:
+    """
+    Turn article *html* into ESC/POS commands, in the order they have to be
+    sent: last line first, text upside down, images rotated by 180°.
+    Images are dithered with *dither* and *gamma*, see raster.pack_image.
+    """
+    parser = ArticleParser(base_url)
+    parser.feed(html)
+    parser.close()
+
+    columns = width // CHAR_WIDTH
+    pieces = []  # top to bottom, each a list of commands
+    for kind, value in parser.blocks:
+        if kind == "text":
+            pieces.extend([_line_command(line)] for line in wrap(value, columns))
+            pieces.append([b"\n"])
+        elif kind == "rule":
+            pieces.append([b"-" * columns + b"\n"])
+        elif kind == "image":
+            pieces.append(_image_commands(value, width, asset_cache, dither, gamma))
+
+    commands = [ESC_INIT_CODEPAGE, ESC_UPSIDE_DOWN]
+    for piece in reversed(pieces):
+        commands.extend(piece)
+    commands.append(ESC_UPRIGHT)
+    return commands
+
+
+def render_article(url: str, width: int = 830, asset_cache=None,
+                   dither: str = "diffusion", gamma: float = GAMMA) -> list[bytes]:
+    """Download the article at *url* (no browser involved) and render it with render_html."""
+    with STAGE_SECONDS.time(stage="page_load"):
+        html = fetch(url).decode("utf-8", "replace")
+    return render_html(html, url, width, asset_cache, dither, gamma)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Render a newsletter as ESC/POS text and images.")
+    parser.add_argument("url", help="Article URL")
+    parser.add_argument("-o", "--output", help="Write the commands to this file instead of printing")
+    args = parser.parse_args()
+
+    commands = render_article(args.url)
+    size = sum(map(len, commands))
+    if args.output:
+        with open(args.output, "wb") as f:
+            f.writelines(commands)
+        print(f"Wrote {size} bytes to {args.output}")
+    else:
+        from tsp800 import print_commands
+        print_commands(commands)
+        print(f"Printed {size} bytes")
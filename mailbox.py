@@ -1,18 +1,395 @@
 #!/usr/bin/env python
 
-from imap_tools import MailBox, AND, OR, NOT
+from imap_tools import MailBox, MailBoxUnencrypted, AND, OR, NOT, U
+from dataclasses import dataclass
+from datetime import datetime
+from email.header import decode_header, make_header
+from email.parser import BytesHeaderParser
+from email.utils import parseaddr, parsedate_to_datetime
+from itertools import takewhile
+import base64
+import binascii
+import json
+import os
+import quopri
 import re
 import time
 import threading
 import queue
-from typing import Optional
+from typing import Callable, Optional
+from metrics import STAGE_SECONDS
+
+# Updated pattern to match the full URL including hyphens, query parameters, etc.
+# Exclude closing parenthesis from the URL
+ARTICLE_URL_PATTERN = r'https://mailchi\.mp/wnti/[A-Za-z0-9\-_]+(?:[?&][^"\s<>()]+)*'
+
+HEADER_FIELDS = 'HEADER.FIELDS (FROM SUBJECT DATE)'
+
+
+@dataclass
+class MailSummary:
+    """
+    The parts of a newsletter mail we actually use: a few headers and the
+    (possibly partial) text or HTML body that contains the article link.
+    Stands in for imap_tools' MailMessage, which needs the full RFC822 message.
+    *feed* names the subscription it was delivered for and *url_pattern* is
+    that subscription's rule for finding the article link (see feeds.py).
+    """
+    uid: str
+    subject: str
+    from_: str
+    date: datetime
+    text: str = ''
+    html: str = ''
+    feed: str = ''
+    url_pattern: str = ARTICLE_URL_PATTERN
+
+
+def _parse_imap(data: bytes) -> list:
+    """
+    Parse an IMAP response into nested lists of bytes (NIL becomes None).
+    Handles quoted strings, {n} literals and section specs like BODY[1.2]<0>.
+    """
+    stack = [[]]
+    i, n = 0, len(data)
+    while i < n:
+        c = data[i:i + 1]
+        if c in b' \r\n':
+            i += 1
+        elif c == b'(':
+            stack.append([])
+            i += 1
+        elif c == b')':
+            done = stack.pop()
+            stack[-1].append(done)
+            i += 1
+        elif c == b'"':
+            j, buf = i + 1, bytearray()
+            while data[j:j + 1] != b'"':
+                if data[j:j + 1] == b'\\':
+                    j += 1
+                buf += data[j:j + 1]
+                j += 1
+            stack[-1].append(bytes(buf))
+            i = j + 1
+        elif c == b'{':
+            j = data.index(b'}', i)
+            size = int(data[i + 1:j])
+            start = data.index(b'\n', j) + 1
+            stack[-1].append(data[start:start + size])
+            i = start + size
+        else:
+            j, depth = i, 0
+            while j < n:
+                c = data[j:j + 1]
+                if c == b'[':
+                    depth += 1
+                elif c == b']':
+                    depth -= 1
+                elif depth == 0 and c in b' ()\r\n':
+                    break
+                j += 1
+            atom = data[i:j]
+            stack[-1].append(None if atom.upper() == b'NIL' else atom)
+            i = j
+    return stack[0]
+
+
+def _fetch_items(fetch_data: list) -> list[dict]:
+    """Turn the data of an imaplib UID FETCH into one {ITEM: value} dict per message."""
+    parts = []
+    for item in fetch_data:
+        if isinstance(item, tuple):
+            parts.append(item[0] + b'\r\n' + item[1])
+        elif item:
+            parts.append(item)
+    tokens = _parse_imap(b' '.join(parts))
+    messages = []
+    for token in tokens:
+        if isinstance(token, list):
+            keys = [key.decode().upper() if isinstance(key, bytes) else key for key in token[::2]]
+            messages.append(dict(zip(keys, token[1::2])))
+    return messages
+
+
+def _text_parts(structure: list, prefix: str = '') -> list[tuple]:
+    """
+    Walk a BODYSTRUCTURE and return (section, subtype, charset, encoding, size)
+    for every text/plain and text/html part, in message order.
+    Attached messages (message/rfc822) are not descended into.
+    """
+    if structure and isinstance(structure[0], list):
+        found = []
+        children = takewhile(lambda part: isinstance(part, list), structure)
+        for i, child in enumerate(children):
+            found.extend(_text_parts(child, f"{prefix}{i + 1}."))
+        return found
+    if len(structure) < 7 or not isinstance(structure[0], bytes):
+        return []
+    maintype, subtype = structure[0].decode().lower(), structure[1].decode().lower()
+    if maintype != 'text' or subtype not in ('plain', 'html'):
+        return []
+    params = structure[2] or []
+    params = {k.decode().lower(): v.decode() for k, v in zip(params[::2], params[1::2])}
+    encoding = (structure[5] or b'7bit').decode().lower()
+    size = int(structure[6] or 0)
+    return [(prefix.rstrip('.') or '1', subtype, params.get('charset', 'utf-8'), encoding, size)]
+
+
+def _decode_part(raw: bytes, charset: str, encoding: str) -> str:
+    """Decode a (possibly truncated) body part."""
+    if encoding == 'base64':
+        compact = re.sub(rb'[^A-Za-z0-9+/=]', b'', raw)
+        try:
+            raw = base64.b64decode(compact[:len(compact) // 4 * 4])
+        except binascii.Error:
+            raw = b''
+    elif encoding == 'quoted-printable':
+        raw = quopri.decodestring(raw)
+    try:
+        return raw.decode(charset, errors='replace')
+    except LookupError:
+        return raw.decode('utf-8', errors='replace')
+
+
+def _read_text(msg: MailSummary, structure: list, chunk_size: int = 16384):
+    """
+    Download the text/plain part of *msg* (or text/html if there is none)
+    in chunks with BODY.PEEK[section]<offset.size>, stopping as soon as the
+    article URL shows up. Inline images and attachments are never fetched.
+
+    The IMAP client is the caller's: this generator yields the FETCH items of
+    the next chunk and expects the fetched messages (see _fetch_items) sent
+    back, so the same loop serves MailSession and the asyncio FolderWatch.
+    The part ends up in msg.text or msg.html.
+    """
+    parts = _text_parts(structure)
+    parts = [p for p in parts if p[1] == 'plain'] or [p for p in parts if p[1] == 'html']
+    if not parts:
+        return
+    section, subtype, charset, encoding, size = parts[0]
+    raw = b''
+    while True:
+        items = yield f'(BODY.PEEK[{section}]<{len(raw)}.{chunk_size}>)'
+        chunk = b''
+        for item in items:
+            chunk = next((v for k, v in item.items() if k.startswith('BODY[')), b'') or b''
+        raw += chunk
+        content = _decode_part(raw, charset, encoding)
+        if len(chunk) < chunk_size or len(raw) >= size:
+            break
+        match = re.search(msg.url_pattern, content)
+        # a match running into the end of the chunk may be cut off
+        if match and match.end() < len(content):
+            break
+    setattr(msg, 'text' if subtype == 'plain' else 'html', content)
+
+
+def _decode_header(value) -> str:
+    return str(make_header(decode_header(value))) if value else ''
+
+
+def _parse_summary(item: dict) -> MailSummary:
+    """Build a MailSummary (without body) from a fetched UID, HEADER.FIELDS item."""
+    header = next((v for k, v in item.items() if k.startswith('BODY[HEADER')), b'')
+    headers = BytesHeaderParser().parsebytes(header or b'')
+    try:
+        date = parsedate_to_datetime(headers['Date'])
+    except (TypeError, ValueError):
+        date = datetime(1900, 1, 1)
+    return MailSummary(uid=item['UID'].decode(), subject=_decode_header(headers.get('Subject')),
+                       from_=parseaddr(headers.get('From', ''))[1], date=date)
+
+
+class MailSession:
+    """
+    Long-lived IMAP session that remembers how far it has read.
+
+    The session logs in once and keeps the connection (and IDLE) open across
+    calls to wait_for_mail(). The highest processed UID is stored together
+    with the folder's UIDVALIDITY in *state_path*, so each check only searches
+    UIDs above that mark. If UIDVALIDITY changes the mark is reset and all
+    unseen messages from the sender are considered again.
+    IDLE is re-issued every *idle_refresh* seconds, well within the 29 minutes
+    after which servers may drop an idling client (rfc2177).
+    """
+
+    def __init__(self, sender: str, host: str, username: str, password: str, folder: str = 'INBOX',
+                 state_path: str = 'mail_state.json', idle_refresh: int = 25 * 60,
+                 heartbeat: Optional[Callable[[], None]] = None,
+                 port: Optional[int] = None, ssl: bool = True):
+        self.sender = sender
+        self.host = host
+        self.username = username
+        self.password = password
+        self.folder = folder
+        self.port = port
+        self.ssl = ssl
+        self.state_path = state_path
+        self.idle_refresh = idle_refresh
+        self.heartbeat = heartbeat or (lambda: None)
+
+        self.mailbox = None
+        self.uidvalidity = None
+        self.last_uid = 0
+        self._load_state()
+
+    def _load_state(self):
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+            self.uidvalidity = state.get("uidvalidity")
+            self.last_uid = state.get("last_uid", 0)
+        except (OSError, ValueError):
+            pass
+
+    def _save_state(self):
+        tmp = f"{self.state_path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"uidvalidity": self.uidvalidity, "last_uid": self.last_uid}, f)
+        os.replace(tmp, self.state_path)
+
+    def connect(self):
+        """Log in and check the stored UID mark against the folder's UIDVALIDITY."""
+        if self.mailbox is not None:
+            return
+        print(f"Connecting to mailbox at {self.host} as {self.username}")
+        if self.ssl:
+            mailbox = MailBox(self.host, self.port or 993)
+        else:
+            mailbox = MailBoxUnencrypted(self.host, self.port or 143)
+        self.mailbox = mailbox.login(self.username, self.password, initial_folder=self.folder)
+        uidvalidity = self.mailbox.folder.status(self.folder, ['UIDVALIDITY'])['UIDVALIDITY']
+        if uidvalidity != self.uidvalidity:
+            print(f"UIDVALIDITY changed ({self.uidvalidity} -> {uidvalidity}), resetting UID mark")
+            self.uidvalidity = uidvalidity
+            self.last_uid = 0
+            self._save_state()
+
+    def close(self):
+        """Log out, ignoring errors from a connection that is already gone."""
+        if self.mailbox is None:
+            return
+        try:
+            self.mailbox.logout()
+        except Exception as e:
+            print(f"Error logging out: {e}")
+        self.mailbox = None
+
+    def _fetch_summaries(self, uids: list[str]) -> list[MailSummary]:
+        """
+        Fetch headers and BODYSTRUCTURE of all *uids* in one batched FETCH,
+        drop mails whose From header is not the sender, then download only the
+        text part of the rest (see _read_text).
+        """
+        result = self.mailbox.client.uid('FETCH', ','.join(uids), f'(UID BODYSTRUCTURE BODY.PEEK[{HEADER_FIELDS}])')
+        summaries = []
+        for item in _fetch_items(result[1]):
+            msg = _parse_summary(item)
+            if self.sender.lower() not in msg.from_.lower():
+                print(f"Skipping mail from {msg.from_}")
+                continue
+            self._fetch_text(msg, item.get('BODYSTRUCTURE') or [])
+            summaries.append(msg)
+        return summaries
+
+    def _fetch_text(self, msg: MailSummary, structure: list):
+        """Download the text part of *msg* over this session, see _read_text."""
+        reader = _read_text(msg, structure)
+        try:
+            items = next(reader)
+            while True:
+                items = reader.send(_fetch_items(self.mailbox.client.uid('FETCH', msg.uid, items)[1]))
+        except StopIteration:
+            pass
+
+    def catch_up(self, limit: Optional[int] = None) -> list:
+        """
+        Fetch all unseen messages from the sender above the UID mark (at most
+        *limit*): one UID SEARCH, one batched header FETCH and a partial fetch
+        of each mail's text part. All of them are marked as seen with a single
+        STORE and the mark is advanced.
+        Returns the messages oldest first, or an empty list if there are none.
+        """
+        with STAGE_SECONDS.time(stage="imap_fetch"):
+            criteria = AND(uid=U(self.last_uid + 1, '*'), from_=self.sender, seen=False)
+            # n:* always matches the newest message, even if its UID is below n
+            uids = [uid for uid in self.mailbox.uids(criteria) if int(uid) > self.last_uid]
+            uids = sorted(uids, key=int)[:limit]
+            if not uids:
+                return []
+            msgs = self._fetch_summaries(uids)
+
+            print(f"Marking {len(uids)} message(s) as seen (UIDs: {','.join(uids)})")
+            # plain STORE, mailbox.flag() would also send an EXPUNGE
+            self.mailbox.client.uid('STORE', ','.join(uids), '+FLAGS', '(\\Seen)')
+        self.last_uid = max(int(uid) for uid in uids)
+        self._save_state()
+        if not msgs:
+            return []
+
+        msgs.sort(key=lambda msg: msg.date.timestamp())
+        for msg in msgs:
+            print(f"Found unseen message: '{msg.subject}' from {msg.from_} (UID: {msg.uid})")
+        return msgs
+
+    def wait_for_mail(self, timeout: int = 300, limit: Optional[int] = None) -> list:
+        """
+        Block until unseen email from the sender arrives or *timeout* seconds pass.
+        Mail that piled up while we were away is returned right away in one batch.
+        Returns the MailMessages (marked as seen, oldest first) or an empty list
+        if the timeout is reached.
+        """
+        self.connect()
+        msgs = self.catch_up(limit)
+        if msgs:
+            return msgs
+
+        end_time = time.time() + timeout
+        self.mailbox.idle.start()
+        idling = True
+        idle_started = waiting_since = time.time()
+        try:
+            while True:
+                remaining = end_time - time.time()
+                if remaining <= 0:
+                    STAGE_SECONDS.observe(time.time() - waiting_since, stage="imap_wait")
+                    return []
+                self.heartbeat()
+
+                responses = self.mailbox.idle.poll(timeout=min(10, remaining))
+                if responses:
+                    print(f"Received responses: {responses}")
+                elif time.time() - idle_started < self.idle_refresh:
+                    continue
+
+                # re-issue IDLE on the same connection, checking for mail in between
+                self.mailbox.idle.stop()
+                idling = False
+                msgs = self.catch_up(limit)
+                if msgs:
+                    STAGE_SECONDS.observe(time.time() - waiting_since, stage="imap_wait")
+                    return msgs
+                self.mailbox.idle.start()
+                idling = True
+                idle_started = time.time()
+        finally:
+            if idling:
+                try:
+                    self.mailbox.idle.stop()
+                except Exception as e:
+                    print(f"Error stopping IDLE mode: {e}")
+
 
 def wait_for_mail(sender: str, host: str, username: str, password: str, folder: str = 'INBOX', timeout: int = 300):
     """
     Block until a new unseen email arrives from the specified sender.
     Returns the first unseen MailMessage instance from that sender and marks it as seen.
     This ensures each email is only handled once.
-    
+
+    This opens a connection just for this call; keep a MailSession around
+    to reuse the connection across calls.
+
     Args:
         sender: Email address of the sender to filter by
         host: IMAP server hostname
@@ -20,161 +397,16 @@ def wait_for_mail(sender: str, host: str, username: str, password: str, folder:
         password: Email account password
         folder: Mailbox folder to check (default: INBOX)
         timeout: Maximum time to wait in seconds (default: 300 seconds / 5 minutes)
-    
+
     Returns:
         The first unseen MailMessage from the sender or None if timeout is reached
     """
-    start_time = time.time()
-    end_time = start_time + timeout
-    
-    print(f"Connecting to mailbox at {host} as {username}")
-    
-    with MailBox(host).login(username, password, initial_folder=folder) as mailbox:
-        # First check if there are any existing unseen messages from the sender
-        print(f"Checking for existing unseen messages from {sender}...")
-        
-        # Try different search criteria to find unseen messages
-        search_criteria = AND(from_=sender, seen=False)
-        existing_msgs = list(mailbox.fetch(search_criteria, limit=1))
-        
-        if existing_msgs:
-            msg = existing_msgs[0]
-            print(f"Found unseen message: '{msg.subject}' from {msg.from_}")
-            
-            # Mark the message as seen to prevent processing it again
-            print(f"Marking message as seen (UID: {msg.uid})")
-            try:
-                mailbox.flag(msg.uid, '\\Seen', True)
-                print("Message marked as seen successfully")
-            except Exception as e:
-                print(f"Error marking message as seen: {e}")
-            
-            return msg
-        
-        # If no unseen messages found, try checking for any messages from the sender
-        # This is a fallback in case the UNSEEN flag is not working correctly
-        print("No unseen messages found, checking for any messages from sender...")
-        all_msgs = list(mailbox.fetch(f'FROM "{sender}"', limit=10))
-        
-        if all_msgs:
-            print(f"Found {len(all_msgs)} total messages from {sender}")
-            print("Message flags:")
-            for i, msg in enumerate(all_msgs[:3]):  # Show up to 3
-                print(f"  {i+1}. Subject: {msg.subject} | Flags: {msg.flags}")
-        
-        print(f"No existing unseen messages from {sender}, waiting for new ones...")
-        print(f"Will wait up to {timeout} seconds for new messages")
-        
-        # Try both IDLE mode and regular polling
-        try:
-            # Start IDLE mode
-            print("Starting IDLE mode...")
-            mailbox.idle.start()
-            
-            while time.time() < end_time:
-                # Calculate remaining time
-                remaining = end_time - time.time()
-                if remaining <= 0:
-                    print("Timeout reached, no new messages received")
-                    return None
-                
-                # Poll for server responses with a shorter timeout
-                poll_timeout = min(10, remaining)
-                print(f"Polling for new messages (timeout: {poll_timeout:.1f}s)...")
-                
-                responses = mailbox.idle.poll(timeout=poll_timeout)
-                
-                if responses:
-                    print(f"Received responses: {responses}")
-                    
-                    # Stop IDLE mode temporarily to perform operations
-                    mailbox.idle.stop()
-                    
-                    # Check for new messages from the sender
-                    print("Checking for new messages after receiving notification...")
-                    
-                    # First try with UNSEEN flag
-                    unseen_msgs = list(mailbox.fetch(AND(from_=sender, seen=False), limit=1))
-                    
-                    if unseen_msgs:
-                        msg = unseen_msgs[0]
-                        print(f"Found unseen message: '{msg.subject}' from {msg.from_}")
-                        
-                        # Mark the message as seen
-                        print(f"Marking message as seen (UID: {msg.uid})")
-                        try:
-                            mailbox.flag(msg.uid, '\\Seen', True)
-                            print("Message marked as seen successfully")
-                        except Exception as e:
-                            print(f"Error marking message as seen: {e}")
-                        
-                        return msg
-                    
-                    # If no unseen messages found, try checking for any recent messages
-                    recent_msgs = list(mailbox.fetch('RECENT', limit=5))
-                    if recent_msgs:
-                        print(f"Found {len(recent_msgs)} recent messages")
-                        for i, msg in enumerate(recent_msgs):
-                            print(f"  {i+1}. From: {msg.from_} | Subject: {msg.subject}")
-                            
-                            # If from the sender, return it
-                            if sender.lower() in msg.from_.lower():
-                                print(f"Found recent message from sender: '{msg.subject}'")
-                                
-                                # Mark the message as seen
-                                print(f"Marking message as seen (UID: {msg.uid})")
-                                try:
-                                    mailbox.flag(msg.uid, '\\Seen', True)
-                                    print("Message marked as seen successfully")
-                                except Exception as e:
-                                    print(f"Error marking message as seen: {e}")
-                                
-                                return msg
-                    
-                    print("No matching messages found despite receiving notifications")
-                    
-                    # Restart IDLE mode
-                    mailbox.idle.start()
-                else:
-                    # No new messages, continue waiting
-                    print("No new messages, continuing to wait...")
-                    
-                    # Periodically check for messages even without IDLE notification
-                    # This helps in case IDLE notifications are not working properly
-                    if time.time() - start_time > 0 and (time.time() - start_time) % 30 < 1:
-                        # Stop IDLE mode temporarily
-                        mailbox.idle.stop()
-                        
-                        print("Performing periodic check for new messages...")
-                        unseen_msgs = list(mailbox.fetch(AND(from_=sender, seen=False), limit=1))
-                        
-                        if unseen_msgs:
-                            msg = unseen_msgs[0]
-                            print(f"Found unseen message during periodic check: '{msg.subject}' from {msg.from_}")
-                            
-                            # Mark the message as seen
-                            print(f"Marking message as seen (UID: {msg.uid})")
-                            try:
-                                mailbox.flag(msg.uid, '\\Seen', True)
-                                print("Message marked as seen successfully")
-                            except Exception as e:
-                                print(f"Error marking message as seen: {e}")
-                            
-                            return msg
-                        
-                        # Restart IDLE mode
-                        mailbox.idle.start()
-            
-            print("Timeout reached, no new messages received")
-            return None
-            
-        finally:
-            # Ensure IDLE is stopped cleanly
-            print("Stopping IDLE mode")
-            try:
-                mailbox.idle.stop()
-            except Exception as e:
-                print(f"Error stopping IDLE mode: {e}")
+    session = MailSession(sender, host, username, password, folder)
+    try:
+        msgs = session.wait_for_mail(timeout, limit=1)
+        return msgs[0] if msgs else None
+    finally:
+        session.close()
 
 
 class MailMonitor:
@@ -183,12 +415,16 @@ class MailMonitor:
     """
     
     def __init__(self, sender: str, host: str, username: str, password: str, 
-                 folder: str = 'INBOX', mail_timeout: int = 300, watchdog_timeout: int = 120):
+                 folder: str = 'INBOX', mail_timeout: int = 300, watchdog_timeout: int = 120,
+                 port: Optional[int] = None, ssl: bool = True, state_path: str = 'mail_state.json'):
         self.sender = sender
         self.host = host
         self.username = username
         self.password = password
         self.folder = folder
+        self.port = port
+        self.ssl = ssl
+        self.state_path = state_path
         self.mail_timeout = mail_timeout
         self.watchdog_timeout = watchdog_timeout
         
@@ -196,6 +432,7 @@ class MailMonitor:
         self.mail_thread = None
         self.watchdog_thread = None
         self.stop_event = threading.Event()
+        self.connected = threading.Event()  # set once the first session has logged in
         self.last_activity = time.time()
         self.restart_count = 0
         
@@ -204,29 +441,38 @@ class MailMonitor:
         thread_id = threading.current_thread().ident
         print(f"Mail worker thread {thread_id} started")
         
+        # One session per worker, so the connection survives quiet periods
+        session = MailSession(self.sender, self.host, self.username, self.password, self.folder,
+                              state_path=self.state_path, heartbeat=self._heartbeat,
+                              port=self.port, ssl=self.ssl)
         try:
             while not self.stop_event.is_set():
                 try:
                     # Update activity timestamp
                     self.last_activity = time.time()
-                    
+
+                    session.connect()
+                    self.connected.set()
+
                     # Wait for mail with the configured timeout
-                    msg = wait_for_mail(self.sender, self.host, self.username, 
-                                      self.password, self.folder, self.mail_timeout)
+                    msgs = session.wait_for_mail(self.mail_timeout)
                     
                     # Update activity timestamp after operation
                     self.last_activity = time.time()
                     
-                    if msg is not None:
-                        # Put the message in the queue for the main thread
-                        self.mail_queue.put(msg)
-                        print(f"Mail worker thread {thread_id} found message: {msg.subject}")
+                    if msgs:
+                        # Put the messages in the queue for the main thread, oldest first
+                        for msg in msgs:
+                            self.mail_queue.put(msg)
+                            print(f"Mail worker thread {thread_id} found message: {msg.subject}")
                     else:
                         # Timeout reached, continue loop
                         print(f"Mail worker thread {thread_id} timeout reached, continuing...")
                         
                 except Exception as e:
                     print(f"Error in mail worker thread {thread_id}: {e}")
+                    # The connection is probably broken, log in again on the next round
+                    session.close()
                     # Update activity to prevent watchdog from restarting due to exceptions
                     self.last_activity = time.time()
                     # Wait a bit before retrying
@@ -235,7 +481,12 @@ class MailMonitor:
         except Exception as e:
             print(f"Fatal error in mail worker thread {thread_id}: {e}")
         finally:
+            session.close()
             print(f"Mail worker thread {thread_id} exiting")
+
+    def _heartbeat(self):
+        """Called by the session while idling so the watchdog knows it is alive."""
+        self.last_activity = time.time()
     
     def _watchdog_worker(self):
         """Watchdog thread that monitors the mail thread and restarts it if it hangs."""
@@ -336,9 +587,11 @@ class MailMonitor:
         return self.restart_count
 
 
-def extract_article_url(msg):
+def extract_article_url(msg, pattern: Optional[str] = None):
     """
-    Extract the first Mailchimp article URL from the given MailMessage.
+    Extract the first article URL from the given MailMessage or MailSummary,
+    matching *pattern*, the message's own url_pattern or the wnti Mailchimp
+    pattern, in that order.
     Returns the URL string or None if not found.
     """
     if msg is None:
@@ -346,9 +599,7 @@ def extract_article_url(msg):
         return None
         
     content = msg.text or msg.html or ''
-    # Updated pattern to match the full URL including hyphens, query parameters, etc.
-    # Exclude closing parenthesis from the URL
-    pattern = r'https://mailchi\.mp/wnti/[A-Za-z0-9\-_]+(?:[?&][^"\s<>()]+)*'
+    pattern = pattern or getattr(msg, 'url_pattern', None) or ARTICLE_URL_PATTERN
     match = re.search(pattern, content)
     
     if match:
@@ -356,5 +607,5 @@ def extract_article_url(msg):
         print(f"Extracted URL: {url}")
         return url
     else:
-        print("No Mailchimp URL found in the message")
+        print("No article URL found in the message")
         return None
@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+"""
+Minimal in-process metrics with a Prometheus text endpoint.
+
+    from metrics import STAGE_SECONDS
+    with STAGE_SECONDS.time(stage="page_load"):
+        ...
+
+`serve()` exposes everything at http://127.0.0.1:9108/metrics.
+"""
+
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Callable
+import os
+import threading
+import time
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(f'{k}="{str(v)}"' for k, v in sorted(labels.items()))
+    return "{" + pairs + "}"
+
+
+class Metric(ABC):
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"] + self.samples()
+
+    @abstractmethod
+    def samples(self) -> list[str]:
+        """The metric's lines in the Prometheus text format, without HELP and TYPE."""
+
+    def drain(self) -> dict:
+        """Take what was recorded since the last drain, for merge() in another process."""
+        return {}
+
+    def merge(self, delta: dict):
+        pass
+
+
+class Counter(Metric):
+    """A value that only goes up."""
+    kind = "counter"
+
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help)
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def drain(self) -> dict:
+        with self.lock:
+            delta, self.values = self.values, {}
+        return delta
+
+    def merge(self, delta: dict):
+        with self.lock:
+            for key, amount in delta.items():
+                self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> list[str]:
+        with self.lock:
+            return [f"{self.name}{_labels(dict(k))} {v}" for k, v in self.values.items()]
+
+
+class Gauge(Metric):
+    """A value that goes up and down, either set directly or read from a function at scrape time."""
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help)
+        self.values: dict[tuple, float] = {}
+        self.function: Callable | None = None
+
+    def set(self, value: float, **labels):
+        with self.lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+    def set_function(self, function: Callable, label: str = "stage"):
+        """*function* returns a number, or a dict of {value of *label*: number}."""
+        self.function = function
+        self.label = label
+
+    def samples(self) -> list[str]:
+        values = dict(self.values)
+        if self.function is not None:
+            try:
+                result = self.function()
+            except Exception as e:
+                print(f"Error reading gauge {self.name}: {e}")
+                result = {}
+            if isinstance(result, dict):
+                values.update({((self.label, k),): v for k, v in result.items()})
+            else:
+                values[()] = result
+        return [f"{self.name}{_labels(dict(k))} {v}" for k, v in values.items()]
+
+
+class Histogram(Metric):
+    """Observations counted into cumulative buckets, plus their count and sum."""
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str,
+                 buckets: tuple = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)):
+        super().__init__(name, help)
+        self.buckets = buckets
+        self.series: dict[tuple, list] = {}  # labels -> [bucket counts..., count, sum]
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.series.setdefault(key, [0] * (len(self.buckets) + 2))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def drain(self) -> dict:
+        with self.lock:
+            delta, self.series = self.series, {}
+        return delta
+
+    def merge(self, delta: dict):
+        with self.lock:
+            for key, other in delta.items():
+                series = self.series.setdefault(key, [0] * (len(self.buckets) + 2))
+                for i, value in enumerate(other):
+                    series[i] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> list[str]:
+        lines = []
+        with self.lock:
+            for key, series in self.series.items():
+                labels = dict(key)
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f"{self.name}_bucket{_labels({**labels, 'le': bound})} {count}")
+                lines.append(f"{self.name}_bucket{_labels({**labels, 'le': '+Inf'})} {series[-2]}")
+                lines.append(f"{self.name}_count{_labels(labels)} {series[-2]}")
+                lines.append(f"{self.name}_sum{_labels(labels)} {series[-1]}")
+        return lines
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics: list[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(line for metric in self.metrics for line in metric.render()) + "\n"
+
+    def drain(self) -> dict:
+        """
+        Counts and observations since the last drain, by metric name. A child
+        process sends these to its parent, which adds them with merge(), so
+        the parent's endpoint covers work done in the child. Gauges stay local.
+        """
+        return {metric.name: delta for metric in self.metrics if (delta := metric.drain())}
+
+    def merge(self, deltas: dict):
+        for metric in self.metrics:
+            if metric.name in deltas:
+                metric.merge(deltas[metric.name])
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "prnti_stage_seconds",
+    "Time spent per step: imap_wait, imap_fetch, url_extract, page_load, capture, resize, dither, usb_transfer"))
+NEWSLETTERS = REGISTRY.register(Counter(
+    "prnti_newsletters_total", "Newsletters by outcome (printed, duplicate, no_url)"))
+PRINTED_BYTES = REGISTRY.register(Counter(
+    "prnti_printed_bytes_total", "Raster bytes sent to the printer"))
+PRINT_FAILURES = REGISTRY.register(Counter(
+    "prnti_print_failures_total", "Print jobs that failed and made the spooler reconnect"))
+MAIL_RESTARTS = REGISTRY.register(Gauge(
+    "prnti_mail_restarts", "Times the mail thread was restarted by the watchdog"))
+QUEUE_DEPTH = REGISTRY.register(Gauge(
+    "prnti_queue_depth", "Jobs waiting in front of each pipeline stage"))
+ASSET_REQUESTS = REGISTRY.register(Counter(
+    "prnti_asset_requests_total", "Page requests by result (cached, fetched, blocked)"))
+WORKER_RESTARTS = REGISTRY.register(Counter(
+    "prnti_worker_restarts_total", "Worker processes killed or restarted by the supervisor, by worker"))
+STARTUP_SECONDS = REGISTRY.register(Gauge(
+    "prnti_startup_seconds", "Seconds from process start until each startup phase was done"))
+
+
+def _process_started() -> float:
+    """Wall-clock time the process was started, including interpreter startup."""
+    try:
+        with open("/proc/self/stat") as f:
+            # the command name may contain spaces, fields after it are fixed
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return time.time() - uptime + start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return time.time()
+
+
+class StartupTimer:
+    """
+    Records when each startup phase finished, counted from process start.
+
+    Phases can be marked from any thread, in any order. Once all *expected*
+    phases are in, the breakdown is printed and the process is ready.
+    """
+
+    def __init__(self, expected: tuple = ()):
+        self.started = _process_started()
+        self.expected = set(expected)
+        self.phases: dict[str, float] = {}
+        self.ready = threading.Event()
+        self.lock = threading.Lock()
+
+    def mark(self, phase: str):
+        elapsed = time.time() - self.started
+        with self.lock:
+            if phase in self.phases:
+                return
+            self.phases[phase] = elapsed
+            done = not self.ready.is_set() and self.expected <= self.phases.keys()
+        STARTUP_SECONDS.set(elapsed, phase=phase)
+        print(f"Startup: {phase} after {elapsed:.2f}s")
+        if done:
+            self.ready.set()
+            self.report()
+
+    def watch(self, phase: str, event: threading.Event):
+        """Mark *phase* as soon as *event* is set."""
+        def waiter():
+            event.wait()
+            self.mark(phase)
+        threading.Thread(target=waiter, name=f"startup-{phase}", daemon=True).start()
+
+    def report(self):
+        with self.lock:
+            phases = sorted(self.phases.items(), key=lambda item: item[1])
+        print("Startup breakdown (seconds since process start):")
+        for phase, elapsed in phases:
+            print(f"  {phase:<12} {elapsed:6.2f}")
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port: int = 9108, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """Serve /metrics in a background thread."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Metrics available at http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
+import queue
+import threading
+
+
+@dataclass
+class Job:
+    """One newsletter (or one band of it) travelling through the pipeline."""
+    seq: int
+    msg: Any = None
+    url: Optional[str] = None
+    image: Any = None
+    raster: Optional[tuple] = None
+    commands: Optional[list] = None  # hybrid mode: ESC/POS text and images, sent as-is
+    last: bool = True  # last piece of its newsletter, feed paper afterwards
+    part: int = 0  # index of the piece (band) within its newsletter
+
+
+class Stage:
+    """
+    One pipeline stage: a single worker thread that takes jobs from *inbox*,
+    runs *func* on them and puts the results into *outbox*.
+
+    *func* may return a job, None (the job is dropped) or an iterable of jobs
+    (e.g. one per band). Because every stage has exactly one worker and the
+    queues are FIFO, jobs leave the pipeline in the order they entered it.
+    The queues are bounded, so a slow stage (the printer) holds back the
+    stages in front of it instead of letting work pile up in memory.
+
+    A stage without an inbox is a source: *func* is called with None in a loop.
+    *setup* runs in the worker thread before the first job, for resources that
+    must live on that thread (Playwright), *teardown* after the last one.
+    """
+
+    def __init__(self, name: str, func: Callable, inbox: Optional[queue.Queue] = None,
+                 outbox: Optional[queue.Queue] = None,
+                 setup: Optional[Callable] = None, teardown: Optional[Callable] = None):
+        self.name = name
+        self.func = func
+        self.inbox = inbox
+        self.outbox = outbox
+        self.setup = setup
+        self.teardown = teardown
+
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.processed = 0
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._worker, name=self.name, daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout: float = 5):
+        self.stop_event.set()
+        if self.thread is not None and self.thread.is_alive():
+            self.thread.join(timeout=timeout)
+
+    def _get(self):
+        if self.inbox is None:
+            return None
+        while not self.stop_event.is_set():
+            try:
+                return self.inbox.get(timeout=1)
+            except queue.Empty:
+                continue
+        raise queue.Empty
+
+    def _put(self, job):
+        while not self.stop_event.is_set():
+            try:
+                self.outbox.put(job, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def _worker(self):
+        print(f"{self.name} stage started")
+        try:
+            if self.setup is not None:
+                self.setup()
+            while not self.stop_event.is_set():
+                try:
+                    job = self._get()
+                except queue.Empty:
+                    break
+                try:
+                    result = self.func(job)
+                    if result is None:
+                        continue
+                    # generators run here, so their errors are caught too
+                    for out in ([result] if isinstance(result, Job) else result):
+                        if self.outbox is not None:
+                            self._put(out)
+                    self.processed += 1
+                except Exception as e:
+                    print(f"Error in {self.name} stage (job {getattr(job, 'seq', '-')}): {e}")
+        finally:
+            if self.teardown is not None:
+                self.teardown()
+            print(f"{self.name} stage exiting")
+
+
+class Pipeline:
+    """A chain of stages connected by bounded queues."""
+
+    def __init__(self, depth: int = 2):
+        self.depth = depth
+        self.stages: list[Stage] = []
+        self._outbox: Optional[queue.Queue] = None
+
+    def add(self, name: str, func: Callable, source: bool = False, **kwargs) -> Stage:
+        """Append a stage reading from the previous stage's output."""
+        inbox = None if source else self._outbox
+        outbox = queue.Queue(maxsize=self.depth)
+        stage = Stage(name, func, inbox, outbox, **kwargs)
+        self.stages.append(stage)
+        self._outbox = outbox
+        return stage
+
+    def start(self):
+        # the last stage's outbox is never read
+        self.stages[-1].outbox = None
+        for stage in self.stages:
+            stage.start()
+
+    def stop(self):
+        for stage in self.stages:
+            stage.stop()
+
+    def queue_depths(self) -> dict[str, int]:
+        return {stage.name: stage.inbox.qsize() for stage in self.stages if stage.inbox is not None}
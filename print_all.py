@@ -1,13 +1,58 @@
 #!/usr/bin/env python
 
-from tsp800 import print_image
+from printers import discover
+from spooler import PrintScheduler
+from archive import RasterArchive
+from argparse import ArgumentParser
 from glob import glob
 from icecream import ic
 from time import sleep
 from tqdm import tqdm
+import os
+import sys
 
 
-files=sorted(glob("newsletters/*.jpg"))
-for file in (pbar:= tqdm(files)):
-    pbar.set_postfix_str(file)
-    print_image(file,cut=False)
+parser = ArgumentParser(description="Reprint the newsletter archive.")
+parser.add_argument("-a", "--archive", action="store_true",
+                    help="Print from the packed raster archive instead of the JPGs")
+parser.add_argument("-p", "--printers", default=os.getenv("PRNTI_PRINTER", "tsp800"),
+                    help="Comma separated printer backends to use, every connected printer of "
+                         "each is used, e.g. tsp800,tm-t88iv or dummy:3 (default: $PRNTI_PRINTER or tsp800)")
+parser.add_argument("--policy", choices=PrintScheduler.POLICIES, default="round-robin",
+                    help="round-robin: one device after the other; least-work: the device with "
+                         "the least queued rows; mirror: every job on every device (default: round-robin)")
+args = parser.parse_args()
+
+devices = discover(args.printers.split(","))
+if not devices:
+    sys.exit("No printers found")
+print(f"Printing on {len(devices)} printer(s): {', '.join(d.name for d in devices)}")
+
+with PrintScheduler(devices, args.policy) as scheduler:
+    if args.archive:
+        archive = RasterArchive("newsletters")
+        skipped = []
+        for key in (pbar:= tqdm(archive.ids())):
+            pbar.set_postfix_str(key)
+            rows, width_bytes, height = archive.rows(key)
+            # packed rows can't be scaled, narrower printers are left out
+            try:
+                scheduler.submit("print_raster", rows, width_bytes, height, cut=False, work=height,
+                                 width=width_bytes * 8)
+            except ValueError as e:
+                skipped.append(key)
+                print(f"Skipping {key}: {e}")
+        scheduler.join()
+        archive.close()
+        if skipped:
+            print(f"Skipped {len(skipped)} newsletter(s) too wide for every printer, print the JPGs instead")
+    else:
+        files=sorted(glob("newsletters/*.jpg"))
+        for file in (pbar:= tqdm(files)):
+            pbar.set_postfix_str(file)
+            scheduler.submit("print_image", file, cut=False, work=os.path.getsize(file))
+        scheduler.join()
+
+for row in scheduler.report():
+    print(f"{row['device']:<20} {row['jobs']:>4} jobs  {row['failed']:>3} failed  "
+          f"{row['busy_s']:>8.1f}s busy  {row['jobs_per_min']:>6.1f} jobs/min  {row['work_per_s']:>10.1f} work/s")
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+"""
+Printer backends: one place for everything that differs between the
+printers prnti drives, USB IDs, escpos profile, paper width, which image
+commands the firmware understands and how much to hand to USB at once.
+
+    from printers import get_backend
+    backend = get_backend("tsp800")
+    backend.print_raster(rows, width_bytes, height)
+
+`python printers.py bench` times every transfer method a backend supports.
+"""
+
+from metrics import PRINTED_BYTES
+from raster import (BAND_ROWS, column_commands, feed_commands, graphics_commands,
+                    pack_image, raster_commands)
+from argparse import ArgumentParser
+from PIL import Image
+import io
+import os
+import time
+
+
+# Image transfer commands, the encoders take (rows, width_bytes, height)
+METHODS = {
+    "raster": raster_commands,      # GS v 0
+    "graphics": graphics_commands,  # GS ( L, fn 112 + 50
+    "column": column_commands,      # ESC *, 24-dot columns
+}
+
+allowed_images = ['.jpg', '.jpeg', '.gif', '.png', '.bmp']
+
+
+def load_image(source):
+    """
+    Accept a path, a PIL Image or a raw encoded image buffer (bytes or file-like)
+    and return it as a PIL Image, without another trip to the disk for buffers.
+    """
+    if isinstance(source, Image.Image):
+        return source
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return Image.open(io.BytesIO(source))
+    if hasattr(source, "read"):
+        return Image.open(source)
+    filename = str(source)
+    assert filename.lower().endswith(tuple(allowed_images)), "File type not supported"
+    return Image.open(filename)
+
+
+class Backend:
+    """
+    A printer model and how to talk to it.
+
+    *methods* lists the image commands the firmware supports, fastest first;
+    the first one is used unless another is picked with use(). Commands are
+    coalesced into USB writes of *chunk_size* bytes: small enough for the
+    printer's receive buffer to keep up, large enough that per-transfer
+    overhead doesn't dominate.
+
+    The print_* functions open the printer themselves unless an open handle
+    is passed as *printer* (what the spooler does).
+    """
+
+    def __init__(self, name: str, vendor_id: int | None = None, product_id: int | None = None,
+                 profile: str | None = None, width_dots: int = 512,
+                 methods: tuple = ("raster",), chunk_size: int = 4096, method: str | None = None):
+        self.name = name
+        self.vendor_id = vendor_id
+        self.product_id = product_id
+        self.profile = profile
+        self.width_dots = width_dots
+        self.methods = methods
+        self.chunk_size = chunk_size
+        self.method = methods[0]
+        if method is not None:
+            self.use(method)
+
+    def __repr__(self):
+        return f"<Backend {self.name} {self.method}, {self.width_dots} dots>"
+
+    def use(self, method: str):
+        """Switch to another supported transfer method."""
+        if method not in self.methods:
+            raise ValueError(f"{self.name} does not support {method!r}, only {', '.join(self.methods)}")
+        self.method = method
+
+    def open(self, bus: int | None = None, address: int | None = None):
+        """
+        Open the printer. Pass the handle as *printer* to keep it open across jobs.
+        *bus* and *address* pick one of several identical printers (see discover).
+        """
+        from escpos.printer import Usb
+        if bus is None:
+            return Usb(self.vendor_id, self.product_id, 0, profile=self.profile)
+        return Usb(self.vendor_id, self.product_id, usb_args={"bus": bus, "address": address},
+                   profile=self.profile)
+
+    def encode(self, rows, width_bytes: int, height: int, method: str | None = None):
+        """Yield the commands printing packed *rows* with *method* (default: the backend's)."""
+        encoder = METHODS[method or self.method]
+        if encoder is column_commands:
+            return encoder(rows, width_bytes, height)
+        return encoder(rows, width_bytes, height, BAND_ROWS)
+
+    def write(self, printer, commands):
+        """Send *commands* in USB writes of about chunk_size bytes."""
+        buffer = bytearray()
+        for command in commands:
+            buffer += command
+            while len(buffer) >= self.chunk_size:
+                printer._raw(bytes(buffer[:self.chunk_size]))
+                del buffer[:self.chunk_size]
+            PRINTED_BYTES.inc(len(command))
+        if buffer:
+            printer._raw(bytes(buffer))
+
+    def _run(self, commands, cut: bool, printer):
+        p = printer if printer is not None else self.open()
+        try:
+            self.write(p, commands)
+            if cut: p.cut()
+        finally:
+            if printer is None: p.close()
+
+    def print_raster(self, rows, width_bytes: int, height: int, cut: bool = True, printer=None):
+        """Print packed 1-bit rows (see raster.pack_image) with the backend's method."""
+        self._run(self.encode(rows, width_bytes, height), cut, printer)
+
+    def print_image(self, image, cut: bool = True, printer=None):
+        """Print *image* (see load_image), scaled down to the paper width if it is wider."""
+        image = load_image(image)
+        if image.width > self.width_dots:
+            image = image.resize((self.width_dots, round(image.height * self.width_dots / image.width)))
+        self.print_raster(*pack_image(image), cut=cut, printer=printer)
+
+    def print_commands(self, commands, cut: bool = False, printer=None):
+        """Send ready-made ESC/POS *commands* (see hybrid.render_html)."""
+        self._run(commands, cut, printer)
+
+    def feed(self, rows: int, cut: bool = False, printer=None):
+        """Advance the paper by *rows* dot rows, much cheaper than printing a blank image."""
+        self._run(feed_commands(rows), cut, printer)
+
+    def print_text(self, text: str, cut: bool = True, printer=None):
+        p = printer if printer is not None else self.open()
+        p.text(text)
+        if cut: p.cut()
+        if printer is None: p.close()
+
+
+class DummyBackend(Backend):
+    """Keeps everything in memory (escpos Dummy), for tests and benchmarks."""
+
+    def open(self, bus=None, address=None):
+        from escpos.printer import Dummy
+        return Dummy()
+
+
+class FileBackend(Backend):
+    """Writes the raw command stream to *path*, e.g. a capture file or /dev/usb/lp0."""
+
+    def __init__(self, name: str, path: str = "printout.bin", **kwargs):
+        super().__init__(name, **kwargs)
+        self.path = path
+
+    def open(self, bus=None, address=None):
+        from escpos.printer import File
+        return File(self.path)
+
+
+BACKENDS: dict[str, Backend] = {}
+
+
+def register(backend: Backend) -> Backend:
+    BACKENDS[backend.name] = backend
+    return backend
+
+
+def get_backend(name: str | None = None) -> Backend:
+    """
+    Return the backend called *name*, by default the configured one in
+    PRNTI_PRINTER (tsp800). PRNTI_PRINTER_METHOD overrides the transfer
+    method of the configured printer.
+    """
+    configured = os.getenv("PRNTI_PRINTER", "tsp800")
+    name = name or configured
+    try:
+        backend = BACKENDS[name]
+    except KeyError:
+        raise ValueError(f"Unknown printer {name!r}, use one of {', '.join(BACKENDS)}") from None
+    method = os.getenv("PRNTI_PRINTER_METHOD")
+    if method and name == configured:
+        backend.use(method)
+    return backend
+
+
+# Epson TM-T88IV: 180 dpi, 72 mm printable on 80 mm paper
+register(Backend("tm-t88iv", 0x04b8, 0x0202, "TM-T88IV", width_dots=512,
+                 methods=("raster", "graphics", "column"), chunk_size=4096))
+# Star TSP800 in ESC/POS emulation: 203 dpi, 104 mm printable on 112 mm paper,
+# no GS ( L in the emulation
+register(Backend("tsp800", 0x0519, 0x0001, "TSP800", width_dots=832,
+                 methods=("raster", "column"), chunk_size=16384))
+register(DummyBackend("dummy", width_dots=832, methods=tuple(METHODS)))
+register(FileBackend("file", os.getenv("PRNTI_PRINTER_FILE", "printout.bin"), width_dots=832,
+                     methods=tuple(METHODS)))
+
+
+class Device:
+    """One attached printer: its backend and where it sits on the USB bus."""
+
+    def __init__(self, backend: Backend, bus: int | None = None, address: int | None = None, index: int = 0):
+        self.backend = backend
+        self.bus = bus
+        self.address = address
+        self.name = f"{backend.name}@{bus}:{address}" if bus is not None else f"{backend.name}#{index}"
+
+    def __repr__(self):
+        return f"<Device {self.name}>"
+
+    def open(self):
+        return self.backend.open(self.bus, self.address)
+
+
+def discover(specs: list[str] | None = None) -> list[Device]:
+    """
+    Find the attached printers of the backends named in *specs* (default:
+    the configured one). USB backends return one Device per printer found
+    on the bus; others take a count, e.g. "dummy:3".
+    """
+    devices = []
+    for spec in specs or [os.getenv("PRNTI_PRINTER", "tsp800")]:
+        name, _, count = spec.partition(":")
+        backend = get_backend(name)
+        if backend.vendor_id is None:
+            devices += [Device(backend, index=i) for i in range(int(count or 1))]
+            continue
+        import usb.core
+        found = list(usb.core.find(find_all=True, idVendor=backend.vendor_id, idProduct=backend.product_id))
+        if not found:
+            print(f"No {backend.name} connected")
+        devices += [Device(backend, d.bus, d.address) for d in found]
+    return devices
+
+
+def benchmark(backend: Backend, image, repeat: int = 3) -> list[dict]:
+    """
+    Print *image* with every method *backend* supports and report bytes on
+    the wire and the best time of *repeat* runs, encoding included.
+    """
+    rows, width_bytes, height = pack_image(load_image(image))
+    results = []
+    for method in backend.methods:
+        size = sum(len(c) for c in backend.encode(rows, width_bytes, height, method))
+        best = float("inf")
+        p = backend.open()
+        try:
+            for _ in range(repeat):
+                start = time.perf_counter()
+                backend.write(p, backend.encode(rows, width_bytes, height, method))
+                best = min(best, time.perf_counter() - start)
+        finally:
+            p.close()
+        results.append({"method": method, "bytes": size, "seconds": round(best, 3),
+                        "rows_per_s": round(height / best) if best else 0})
+    return results
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="List printer backends or benchmark their transfer methods.")
+    parser.add_argument("command", choices=["list", "bench"], nargs="?", default="list")
+    parser.add_argument("-p", "--printer", help="Backend to benchmark (default: $PRNTI_PRINTER or tsp800)")
+    parser.add_argument("-i", "--image", default="test_image.jpg", help="Image to print (default: test_image.jpg)")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="Runs per method, the best counts (default: 3)")
+    args = parser.parse_args()
+
+    if args.command == "list":
+        for backend in BACKENDS.values():
+            print(f"{backend.name:<10} {backend.width_dots} dots, methods: {', '.join(backend.methods)}, "
+                  f"chunks of {backend.chunk_size} bytes")
+    else:
+        backend = get_backend(args.printer)
+        image = load_image(args.image)
+        if image.width != backend.width_dots:
+            image = image.resize((backend.width_dots, round(image.height * backend.width_dots / image.width)))
+        print(f"Benchmarking {backend.name} with {args.image} ({image.width}x{image.height})")
+        for result in benchmark(backend, image, args.repeat):
+            print(f"  {result['method']:<9} {result['bytes']:>9} bytes  {result['seconds']:>7.3f}s  "
+                  f"{result['rows_per_s']:>6} rows/s")
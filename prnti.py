@@ -1,10 +1,20 @@
 #!/usr/bin/env python
 
-from tsp800 import print_image
+# Only light modules are imported up front. Playwright, PIL and escpos are
+# imported on the threads that need them, after IMAP is already connecting.
+from metrics import STAGE_SECONDS, NEWSLETTERS, MAIL_RESTARTS, QUEUE_DEPTH, StartupTimer
+import metrics
+from spooler import PrintSpooler
 from mailbox import MailMonitor, extract_article_url
-from browser import full_page_screenshot
-from icecream import ic
+from pipeline import Job, Pipeline
+from archive import RasterArchive
+from store import NewsletterStore, normalise_url, url_key
+from assets import AssetCache
+from argparse import ArgumentParser
+import itertools
 import os
+import threading
+import time
 import signal
 import sys
 from dotenv import load_dotenv
@@ -21,19 +31,349 @@ def signal_handler(sig, frame):
     sys.exit(0)
 
 
+def printer_backend():
+    """The printer in PRNTI_PRINTER (default tsp800), see printers.py."""
+    from printers import get_backend
+    return get_backend()
+
+
+def connect_printer():
+    return printer_backend().open()
+
+
+def print_raster(*args, **kwargs):
+    return printer_backend().print_raster(*args, **kwargs)
+
+
+def print_commands(*args, **kwargs):
+    return printer_backend().print_commands(*args, **kwargs)
+
+
+def feed(*args, **kwargs):
+    return printer_backend().feed(*args, **kwargs)
+
+
+# Paper fed after every newsletter, as much as the old whitespace.jpg took
+FEED_ROWS = 1700
+
+
+def reprint(url: str, store: NewsletterStore, raster_cache: RasterArchive, spooler: PrintSpooler) -> bool:
+    """Print the cached raster of an already rendered newsletter, without the browser."""
+    record = store.get(url)
+    if record is None or record["raster_key"] not in raster_cache:
+        return False
+    spooler.submit(print_raster, *raster_cache.rows(record["raster_key"]), cut=False).result()
+    spooler.submit(feed, FEED_ROWS).result()
+    store.set_state(url, "printed")
+    return True
+
+
+def build_pipeline(mail_monitor: MailMonitor, spooler: PrintSpooler,
+                   store: NewsletterStore, raster_cache: RasterArchive,
+                   mode: str = "raster", archive_dir: str | None = None,
+                   warm: bool = True, startup: StartupTimer | None = None,
+                   asset_cache: AssetCache | None = None,
+                   dither: str = "diffusion", gamma: float | None = None,
+                   max_blank: int | None = None, width: int | None = None,
+                   max_pixels: int | None = None, oversize: str = "split",
+                   isolate: bool = False, render_deadline: float = 180,
+                   failed: threading.Event | None = None) -> Pipeline:
+    """
+    Wire the daemon as ingest -> extract -> render -> rasterise -> print,
+    so the next newsletter is rendered and dithered while the current one
+    is still printing.
+    Newsletters that were printed before, or of which another copy is
+    still on its way to the printer, are dropped after extraction;
+    ones that were rendered but never printed skip straight to the printer
+    with their cached raster.
+    With *warm* the browser is launched as soon as the render stage starts,
+    so the first newsletter does not pay for it; *startup* is told once it is up.
+    Pages are loaded through *asset_cache*, if given. *dither* and *gamma*
+    are passed on to raster.pack_image, blank runs longer than *max_blank*
+    rows are collapsed (0 keeps them).
+    Pages are rendered straight at the printer's dot width (*width*, default
+    the backend's), so screenshots need no resampling. A page above
+    *max_pixels* is captured and printed in bands (*oversize* "split") or
+    dropped ("refuse"). Its bands are still cached as one raster, and with
+    *archive_dir* the page is archived as the dithered PNG that was printed.
+    With *isolate* the browser runs in a supervised child process
+    (supervisor.RenderWorker) that is killed if a page takes longer than
+    *render_deadline* seconds; it sets *failed* when it runs out of restarts.
+    """
+    seq = itertools.count()
+    # URLs between extract and print, a second copy of one is dropped
+    in_flight = set()
+    # Keep one warm browser around instead of launching Chromium per newsletter.
+    # It lives on the render thread, Playwright is bound to it, or in its own
+    # process with *isolate*.
+    browser_pool = None
+    print_width = width
+    # packed rows of the bands of the page being rasterised, for the cache,
+    # and the blank rows at the end of the last band
+    page_rows = []
+    blank_run = 0
+
+    def dots():
+        nonlocal print_width
+        if print_width is None:
+            print_width = printer_backend().width_dots
+        return print_width
+
+    def pool():
+        nonlocal browser_pool
+        if browser_pool is None and isolate:
+            from supervisor import RenderWorker
+            cache_args = {}
+            if asset_cache is not None:
+                cache_args = dict(asset_cache_dir=str(asset_cache.directory),
+                                  asset_cache_mb=asset_cache.max_bytes // (1024 * 1024))
+            browser_pool = RenderWorker(render_deadline, print_width=dots(), failed=failed, **cache_args)
+        elif browser_pool is None:
+            from browser import BrowserPool
+            browser_pool = BrowserPool(size=1, asset_cache=asset_cache, print_width=dots())
+        return browser_pool
+
+    def warm_browser():
+        try:
+            pool().start()
+        except Exception as e:
+            # not fatal, the pool retries on the first page
+            print(f"Could not pre-warm the browser: {e}")
+            return
+        if startup is not None:
+            startup.mark("browser")
+
+    def close_browser():
+        if browser_pool is not None:
+            browser_pool.stop()
+
+    def ingest(_):
+        # Wait for an email
+        msg = mail_monitor.get_message(timeout=1)
+        if msg is None:
+            return None
+        # Log restart count for monitoring
+        restart_count = mail_monitor.get_restart_count()
+        if restart_count > 0:
+            print(f"Mail monitor has restarted {restart_count} times")
+        return Job(seq=next(seq), msg=msg)
+
+    def extract(job):
+        with STAGE_SECONDS.time(stage="url_extract"):
+            job.url = extract_article_url(job.msg)
+        print("Article URL:", job.url)
+        if not job.url:
+            print("No article URL found in the email")
+            NEWSLETTERS.inc(outcome="no_url")
+            return None
+        record = store.get(job.url)
+        if record is not None and record["state"] == "printed":
+            print(f"Newsletter {job.url} was printed before, skipping duplicate")
+            NEWSLETTERS.inc(outcome="duplicate")
+            return None
+        if normalise_url(job.url) in in_flight:
+            # another copy (forwarded, resent) is still rendering or printing
+            print(f"Newsletter {job.url} is already queued, skipping duplicate")
+            NEWSLETTERS.inc(outcome="duplicate")
+            return None
+        in_flight.add(normalise_url(job.url))
+        store.set_state(job.url, "queued")
+        if record is not None and record["raster_key"] in raster_cache:
+            print(f"Using cached raster for {job.url}")
+            job.raster = raster_cache.rows(record["raster_key"])
+        return job
+
+    def give_up(job):
+        """A later copy of a newsletter that failed is printed again."""
+        in_flight.discard(normalise_url(job.url))
+        store.set_state(job.url, "failed")
+
+    def render(job):
+        try:
+            yield from render_bands(job)
+        except Exception:
+            give_up(job)
+            raise
+
+    def render_bands(job):
+        if job.raster is not None:
+            yield job
+            return
+        # Visit the URL in mobile mode and take a screenshot of the full page
+        print(f"Rendering newsletter {job.seq}...")
+        if mode == "hybrid":
+            # text as printer fonts, only the pictures as raster
+            from hybrid import render_article
+            from raster import GAMMA
+            job.commands = render_article(job.url, width=dots(), asset_cache=asset_cache,
+                                          dither=dither, gamma=GAMMA if gamma is None else gamma)
+            yield job
+            return
+        from browser import MAX_PIXELS, capture_page, capture_bands, save_image
+        budget = MAX_PIXELS if max_pixels is None else max_pixels
+        if isolate:
+            # same three cases, rendered by the worker process against its deadline
+            bands = pool().bands(job.url, 600 if mode == "stream" else None, dots(), budget,
+                                 split=mode == "stream" or oversize == "split")
+        elif mode == "stream":
+            # paper starts moving with the first band, memory stays at one band
+            bands = capture_bands(job.url, width=dots(), pool=pool(), max_pixels=budget)
+        elif oversize == "split":
+            # the whole page in one piece, or in bands if it is over the pixel budget
+            bands = capture_bands(job.url, None, dots(), pool=pool(), max_pixels=budget)
+        else:
+            bands = iter([capture_page(job.url, pool=pool(), max_pixels=budget, width=dots())])
+        band = next(bands, None)
+        part = 0
+        while band is not None:
+            following = next(bands, None)
+            if archive_dir and mode != "stream" and part == 0 and following is None:
+                save_image(band, os.path.join(archive_dir, time.strftime("%Y-%m-%d_%H%M%S.jpg")))
+            yield Job(seq=job.seq, url=job.url, image=band, last=following is None, part=part)
+            band = following
+            part += 1
+
+    def rasterise(job):
+        try:
+            return rasterise_job(job)
+        except Exception:
+            give_up(job)
+            raise
+
+    def rasterise_job(job):
+        nonlocal blank_run
+        from raster import pack_image, collapse_blank_rows, trailing_blank_rows, GAMMA, MAX_BLANK_ROWS
+        if job.raster is not None or job.commands is not None:
+            return job
+        if job.part == 0:
+            page_rows.clear()
+            blank_run = 0
+        job.raster = pack_image(job.image, dither, GAMMA if gamma is None else gamma)
+        blank = MAX_BLANK_ROWS if max_blank is None else max_blank
+        if blank:
+            height = job.raster[2]
+            # a blank run can go on across the band edge
+            job.raster = collapse_blank_rows(*job.raster, blank, blank_before=blank_run)
+            tail = trailing_blank_rows(*job.raster)
+            blank_run = blank_run + tail if tail == job.raster[2] else tail
+            print(f"Collapsed blank space: {height} -> {job.raster[2]} rows")
+        job.image = None
+        if not job.last:
+            page_rows.append(bytes(job.raster[0]))
+            return job
+        # keep the printer-ready rows of the whole page, a reprint then skips the browser
+        # entirely; bands come bottom first, so their rows simply follow each other
+        rows, width_bytes, height = job.raster
+        if page_rows:
+            rows = b"".join(page_rows) + bytes(rows)
+            height = len(rows) // width_bytes
+            page_rows.clear()
+            if archive_dir and mode != "stream":
+                # the page was never in memory as one image, archive what was printed
+                from PIL import Image
+                import numpy as np
+                path = os.path.join(archive_dir, time.strftime("%Y-%m-%d_%H%M%S.png"))
+                # 1 is black in the raster but white in a PIL bilevel image
+                inverted = np.invert(np.frombuffer(rows, dtype=np.uint8)).tobytes()
+                Image.frombytes("1", (width_bytes * 8, height), inverted).save(path)
+        key = url_key(job.url)
+        raster_cache.add_rows(key, rows, width_bytes, height)
+        store.set_state(job.url, "rendered", raster_key=key)
+        return job
+
+    def print_job(job):
+        try:
+            if job.commands is not None:
+                spooler.submit(print_commands, job.commands).result()
+            else:
+                spooler.submit(print_raster, *job.raster, cut=False).result()
+            if job.last:
+                spooler.submit(feed, FEED_ROWS).result()
+        except Exception:
+            give_up(job)
+            raise
+        if job.last:
+            store.set_state(job.url, "printed")
+            in_flight.discard(normalise_url(job.url))
+            NEWSLETTERS.inc(outcome="printed")
+            print(f"Newsletter {job.seq} printed")
+        return job
+
+    pipeline = Pipeline(depth=2)
+    pipeline.add("ingest", ingest, source=True)
+    pipeline.add("extract", extract)
+    pipeline.add("render", render, setup=warm_browser if warm and mode != "hybrid" else None, teardown=close_browser)
+    pipeline.add("rasterise", rasterise)
+    pipeline.add("print", print_job)
+    return pipeline
+
+
 if __name__=="__main__":
+    parser = ArgumentParser(description="Print every new wnti newsletter.")
+    parser.add_argument("-m", "--mode", choices=["raster", "stream", "hybrid"], default="raster",
+                        help="raster: capture the whole page, then print it; "
+                             "stream: capture and print the page band by band; "
+                             "hybrid: print the text with the printer's font and only the images as raster, "
+                             "no browser needed (default: raster)")
+    parser.add_argument("--reprint", metavar="URL",
+                        help="Print the cached raster of an already rendered newsletter and exit")
+    parser.add_argument("-d", "--dither", choices=["diffusion", "bayer", "threshold"], default="diffusion",
+                        help="How grey levels become dots: diffusion for photos, bayer for a regular "
+                             "pattern, threshold for text only (default: diffusion)")
+    parser.add_argument("-g", "--gamma", type=float,
+                        help="Gamma applied before dithering, below 1 lightens mid-tones (default: 0.8)")
+    parser.add_argument("-b", "--max-blank", type=int, metavar="ROWS",
+                        help="Collapse longer runs of blank rows to this many, 0 prints them all (default: 48)")
+    parser.add_argument("--oversize", choices=["split", "refuse"], default="split",
+                        help="What to do with pages above the pixel budget (PRNTI_MAX_PIXELS): "
+                             "capture and print them in bands, or skip them (default: split)")
+    parser.add_argument("--no-warm", action="store_true",
+                        help="Do not launch the browser and claim the printer before the first newsletter")
+    parser.add_argument("--feeds", metavar="FILE", default=os.getenv("PRNTI_FEEDS"),
+                        help="Watch all subscriptions in this file on one connection per mailbox "
+                             "instead of the single WNTI_SENDER feed, see feeds.py (default: $PRNTI_FEEDS)")
+    parser.add_argument("--no-isolate", action="store_true",
+                        help="Run IMAP and the browser on threads of this process instead of in "
+                             "supervised child processes that are killed when they hang")
+    args = parser.parse_args()
+
+    if args.no_warm:
+        expected = ("imap",)
+    elif args.mode == "hybrid":
+        expected = ("imap", "printer")
+    else:
+        expected = ("imap", "browser", "printer")
+    startup = StartupTimer(expected=expected)
+    startup.mark("imports")
+
     # Set up signal handlers for graceful shutdown
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
-    
+
     host=os.getenv("PRNTI_MAIL_HOST")
     sender=os.getenv("WNTI_SENDER")
     password=os.getenv("PRNTI_MAIL_PASS")
     username=os.getenv("PRNTI_MAIL_USER")
-    #ic(host,sender,password,username)
-    
+    archive_dir=os.getenv("PRNTI_ARCHIVE_DIR")  # optional, keeps a JPG of every printed newsletter (PNG if split)
+    #from icecream import ic; ic(host,sender,password,username)
+
+    store = NewsletterStore(os.getenv("PRNTI_DB", "prnti.db"))
+    raster_cache = RasterArchive(os.getenv("PRNTI_RASTER_CACHE", "cache"))
+    asset_cache = AssetCache(os.getenv("PRNTI_ASSET_CACHE", "cache/assets"),
+                             int(os.getenv("PRNTI_ASSET_CACHE_MB", "200")))
+
+    if args.reprint:
+        with PrintSpooler(connect_printer) as spooler:
+            if not reprint(args.reprint, store, raster_cache, spooler):
+                print(f"No cached raster for {args.reprint}")
+                sys.exit(1)
+        sys.exit(0)
+
+    # Set by a supervised worker that keeps dying, we exit and systemd restarts us
+    gave_up = threading.Event()
+
     # Create and start the mail monitor with 2-minute watchdog timeout
-    mail_monitor = MailMonitor(
+    mail_settings = dict(
         sender=sender,
         host=host,
         username=username,
@@ -41,48 +381,58 @@ if __name__=="__main__":
         mail_timeout=300,  # 5 minutes for individual mail operations
         watchdog_timeout=120  # 2 minutes watchdog timeout
     )
-    
+    if args.feeds:
+        # every newsletter on one asyncio loop, reads time out instead of hanging
+        from feeds import FeedMonitor, load_subscriptions
+        mail_monitor = FeedMonitor(load_subscriptions(args.feeds))
+    elif args.no_isolate:
+        mail_monitor = MailMonitor(**mail_settings)
+    else:
+        # a hung session is killed with its socket instead of left behind
+        from supervisor import ProcessMailMonitor
+        mail_monitor = ProcessMailMonitor(**mail_settings, failed=gave_up)
+
+    # IMAP first: mail that arrived while we were down is fetched while
+    # the browser and printer are still warming up
     print("Starting mail monitoring system...")
     mail_monitor.start()
-    
+    startup.watch("imap", mail_monitor.connected)
+
+    # Keep one open printer handle instead of claiming the USB device per image
+    spooler = PrintSpooler(connect_printer).start()
+    if not args.no_warm:
+        spooler.warm_up()
+    startup.watch("printer", spooler.connected)
+
+    pipeline = build_pipeline(mail_monitor, spooler, store, raster_cache, args.mode, archive_dir,
+                              warm=not args.no_warm, startup=startup, asset_cache=asset_cache,
+                              dither=args.dither, gamma=args.gamma, max_blank=args.max_blank,
+                              width=int(os.getenv("PRNTI_PRINT_WIDTH") or 0) or None,
+                              max_pixels=int(os.getenv("PRNTI_MAX_PIXELS") or 0) or None,
+                              oversize=args.oversize, isolate=not args.no_isolate,
+                              render_deadline=float(os.getenv("PRNTI_RENDER_DEADLINE", "180")),
+                              failed=gave_up)
+    pipeline.start()
+
+    MAIL_RESTARTS.set_function(mail_monitor.get_restart_count)
+    QUEUE_DEPTH.set_function(pipeline.queue_depths)
+    metrics.serve(int(os.getenv("PRNTI_METRICS_PORT", "9108")))
+    startup.mark("started")
+
     try:
-        while True:
-            # Wait for an email and extract the article URL
-            print("Waiting for email...")
-            msg = mail_monitor.get_message(timeout=None)  # Block indefinitely
-            
-            if msg is None:
-                print("No message received (this shouldn't happen with timeout=None)")
-                continue
-                
-            # Extract the article URL
-            article_url = extract_article_url(msg)
-            print("Article URL:", article_url)
-            
-            if article_url:
-                # Visit the URL in mobile mode, take a screenshot of the full page, and print it
-                print("Visiting article URL and printing screenshot...")
-                screenshot_file = full_page_screenshot(article_url)
-                if screenshot_file:
-                    print(f"Screenshot saved to {screenshot_file} and printed successfully")
-                    print_image(screenshot_file, cut=False)
-                    print_image("whitespace.jpg", cut=False)
-                    os.remove(screenshot_file)
-                else:
-                    print("Failed to take or print screenshot")
-            else:
-                print("No article URL found in the email")
-                
-            # Log restart count for monitoring
-            restart_count = mail_monitor.get_restart_count()
-            if restart_count > 0:
-                print(f"Mail monitor has restarted {restart_count} times")
-                
+        while not gave_up.wait(60):
+            pass
+        print("A worker ran out of restarts, exiting")
+        exit_code = 1
     except KeyboardInterrupt:
         print("\nShutdown requested by user")
-    except Exception as e:
-        print(f"Unexpected error in main loop: {e}")
+        exit_code = 0
     finally:
         print("Stopping mail monitor...")
         mail_monitor.stop()
         print("Mail monitor stopped")
+        pipeline.stop()
+        spooler.stop()
+        store.close()
+        asset_cache.close()
+    sys.exit(exit_code)
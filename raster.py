@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+from PIL import Image
+from metrics import STAGE_SECONDS
+import numpy as np
+import struct
+
+
+# GS v 0 takes at most this many rows per command on most printers
+BAND_ROWS = 256
+
+# Longest run of blank rows left in a printout, about 6 mm of paper
+MAX_BLANK_ROWS = 48
+
+DITHER_METHODS = ("diffusion", "bayer", "threshold")
+
+# Thermal dots bleed into their neighbours, so mid-tones print darker than
+# they should. An exponent below 1 lifts them before dithering.
+GAMMA = 0.8
+
+# 8x8 ordered dither thresholds, spread evenly over 0..255
+_BAYER = np.array([
+    [0, 32, 8, 40, 2, 34, 10, 42],
+    [48, 16, 56, 24, 50, 18, 58, 26],
+    [12, 44, 4, 36, 14, 46, 6, 38],
+    [60, 28, 52, 20, 62, 30, 54, 22],
+    [3, 35, 11, 43, 1, 33, 9, 41],
+    [51, 19, 59, 27, 49, 17, 57, 25],
+    [15, 47, 7, 39, 13, 45, 5, 37],
+    [63, 31, 55, 23, 61, 29, 53, 21],
+], dtype=np.uint16) * 4 + 2
+
+
+def _gamma_lut(gamma: float) -> list[int]:
+    return [round(255 * (i / 255) ** gamma) for i in range(256)]
+
+
+def dither(image: Image.Image, method: str = "diffusion", gamma: float = GAMMA,
+           threshold: int = 128) -> np.ndarray:
+    """
+    Convert *image* to a boolean array with True for every black dot.
+
+    method is one of
+        diffusion: Floyd-Steinberg error diffusion (PIL's C implementation),
+                   best for photos
+        bayer:     8x8 ordered dither, a regular pattern that stays crisp
+                   on the coarse thermal head
+        threshold: plain cut at *threshold*, for text and line art
+    *gamma* is applied to the grey levels first, 1 leaves them unchanged.
+    """
+    grey = image.convert("L")
+    if gamma != 1:
+        grey = grey.point(_gamma_lut(gamma))
+    if method == "diffusion":
+        # mode "1" is True for white
+        return ~np.asarray(grey.convert("1"))
+    pixels = np.asarray(grey)
+    if method == "bayer":
+        height, width = pixels.shape
+        rows = np.arange(height) % 8
+        cols = np.arange(width) % 8
+        return pixels < _BAYER[rows[:, None], cols[None, :]]
+    if method == "threshold":
+        return pixels < threshold
+    raise ValueError(f"Unknown dither method {method!r}, use one of {', '.join(DITHER_METHODS)}")
+
+
+def pack_image(image: Image.Image, method: str = "diffusion", gamma: float = GAMMA) -> tuple[bytes, int, int]:
+    """
+    Dither *image* to 1 bit (see dither) and pack it into printer-ready rows
+    (MSB first, 1 = black dot). Rows are padded with white to whole bytes,
+    so an 830 px wide image becomes 104 bytes per row.
+    Returns (rows, width_bytes, height).
+    """
+    with STAGE_SECONDS.time(stage="dither"):
+        dots = dither(image, method, gamma)
+        height, width = dots.shape
+        # packbits pads the last byte of every row with 0, i.e. white
+        return np.packbits(dots, axis=1).tobytes(), (width + 7) // 8, height
+
+
+def collapse_blank_rows(rows, width_bytes: int, height: int,
+                        max_blank: int = MAX_BLANK_ROWS, blank_before: int = 0) -> tuple[bytes, int, int]:
+    """
+    Shorten every run of blank (all white) packed rows to at most *max_blank*
+    rows. Newsletter layouts are full of spacer blocks and wide margins, and
+    each blank row costs as much print time and USB transfer as a full one.
+    *blank_before* blank rows were printed right before these (the end of the
+    previous band, see trailing_blank_rows) and count towards the first run.
+    Returns (rows, width_bytes, height) like pack_image.
+    """
+    dots = np.frombuffer(rows, dtype=np.uint8, count=width_bytes * height).reshape(height, width_bytes)
+    blank = ~dots.any(axis=1)
+    index = np.arange(height)
+    # index of the last row with ink at or before each row, before the first
+    # one the run that started *blank_before* rows earlier
+    last_ink = np.maximum.accumulate(np.where(blank, -1 - blank_before, index))
+    keep = ~blank | (index - last_ink <= max_blank)
+    kept = dots[keep]
+    return kept.tobytes(), width_bytes, len(kept)
+
+
+def trailing_blank_rows(rows, width_bytes: int, height: int) -> int:
+    """Number of blank rows at the end of packed *rows*."""
+    dots = np.frombuffer(rows, dtype=np.uint8, count=width_bytes * height).reshape(height, width_bytes)
+    ink = np.flatnonzero(dots.any(axis=1))
+    return height - 1 - int(ink[-1]) if len(ink) else height
+
+
+def feed_commands(rows: int):
+    """Yield ESC J commands that feed the paper by *rows* dot rows without printing."""
+    while rows > 0:
+        step = min(rows, 255)
+        yield b"\x1bJ" + bytes([step])
+        rows -= step
+
+
+def raster_commands(rows, width_bytes: int, height: int, band_rows: int = BAND_ROWS):
+    """
+    Yield ESC/POS "GS v 0" raster commands for packed *rows*, one per band of
+    at most *band_rows* rows. *rows* may be any buffer, e.g. a memoryview into
+    an mmap, and is only sliced, never decoded.
+    """
+    for y in range(0, height, band_rows):
+        band = min(band_rows, height - y)
+        header = b"\x1dv0\x00" + struct.pack("<HH", width_bytes, band)
+        yield header + rows[y * width_bytes:(y + band) * width_bytes]
+
+
+def graphics_commands(rows, width_bytes: int, height: int, band_rows: int = BAND_ROWS):
+    """
+    Yield ESC/POS "GS ( L" graphics commands for packed *rows*: each band is
+    stored in the print buffer (fn 112) and printed (fn 50). The data layout
+    is the same as for GS v 0, only the header differs.
+    """
+    print_buffer = b"\x1d(L\x02\x000\x32"
+    for y in range(0, height, band_rows):
+        band = min(band_rows, height - y)
+        data = rows[y * width_bytes:(y + band) * width_bytes]
+        header = (b"\x1d(L" + struct.pack("<H", 10 + len(data)) + b"0\x70" + b"0\x01\x01" + b"1"
+                  + struct.pack("<HH", width_bytes * 8, band))
+        yield header + data
+        yield print_buffer
+
+
+def column_commands(rows, width_bytes: int, height: int):
+    """
+    Yield ESC * column bit-image commands (24-dot double density) for packed
+    *rows*. Every 24 rows are transposed into 3-byte columns; the line
+    spacing is set to 24 dots so the bands join up, and reset afterwards.
+    """
+    dots = np.unpackbits(np.frombuffer(rows, dtype=np.uint8, count=width_bytes * height)
+                         .reshape(height, width_bytes), axis=1)
+    width = width_bytes * 8
+    yield b"\x1b3\x18"
+    for y in range(0, height, 24):
+        band = np.zeros((24, width), dtype=np.uint8)
+        chunk = dots[y:y + 24]
+        band[:len(chunk)] = chunk
+        # column-major, top dot in the MSB of the first byte
+        columns = np.packbits(band.T, axis=1)
+        yield b"\x1b*\x21" + struct.pack("<H", width) + columns.tobytes() + b"\n"
+    yield b"\x1b2"
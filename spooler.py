@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+
+from metrics import STAGE_SECONDS, PRINT_FAILURES
+from concurrent.futures import Future
+import queue
+import threading
+import time
+from typing import Callable
+
+
+_STOP = object()
+_CONNECT = object()
+
+
+class PrintSpooler:
+    """
+    Background print spooler that owns a single open printer handle.
+
+    Jobs are functions like tsp800.print_image that accept a *printer*
+    keyword; the spooler calls them with its open handle, so USB
+    enumeration and claim/release happen once per process instead of once
+    per image. The job queue is bounded: submit() blocks while it is full,
+    which keeps producers from rendering far ahead of the paper.
+    If a job fails the handle is dropped, the printer reconnected and the
+    job retried.
+    """
+
+    def __init__(self, connect: Callable, max_jobs: int = 4, retries: int = 3,
+                 reconnect_delay: float = 2):
+        self.connect = connect
+        self.retries = retries
+        self.reconnect_delay = reconnect_delay
+
+        self.jobs = queue.Queue(maxsize=max_jobs)
+        self.printer = None
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.connected = threading.Event()
+        self.reconnect_count = 0
+
+    def start(self):
+        """Start the spooler thread."""
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self, timeout: float | None = None):
+        """
+        Print everything still queued, then release the printer. A printer
+        that is not there is tried once more but no longer waited for: the
+        remaining jobs fail instead of blocking the shutdown.
+        """
+        self.stop_event.set()
+        if self.thread is not None and self.thread.is_alive():
+            self.jobs.put(_STOP)
+            self.thread.join(timeout=timeout)
+        self._disconnect()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def submit(self, func: Callable, *args, **kwargs) -> Future:
+        """
+        Queue func(*args, printer=<handle>, **kwargs). Blocks while the queue is
+        full. Returns a Future that resolves once the job has been printed.
+        """
+        future = Future()
+        self.jobs.put((future, func, args, kwargs))
+        return future
+
+    def warm_up(self):
+        """Claim the printer in the background now instead of on the first job."""
+        self.jobs.put(_CONNECT)
+
+    def join(self):
+        """Block until every submitted job has been handled."""
+        self.jobs.join()
+
+    def _connect(self):
+        # once stopping, one more try for the jobs still queued, no waiting
+        while self.printer is None:
+            try:
+                self.printer = self.connect()
+                self.connected.set()
+            except Exception as e:
+                if self.stop_event.is_set():
+                    print(f"Printer not available ({e}), giving up")
+                    return
+                print(f"Printer not available ({e}), retrying in {self.reconnect_delay}s")
+                self.stop_event.wait(self.reconnect_delay)
+
+    def _disconnect(self):
+        if self.printer is not None:
+            try:
+                self.printer.close()
+            except Exception as e:
+                print(f"Error closing printer: {e}")
+            self.printer = None
+            self.connected.clear()
+
+    def _worker(self):
+        print("Print spooler started")
+        while True:
+            job = self.jobs.get()
+            if job is _STOP:
+                self.jobs.task_done()
+                break
+            if job is _CONNECT:
+                self._connect()
+                self.jobs.task_done()
+                continue
+            future, func, args, kwargs = job
+            if future.set_running_or_notify_cancel():
+                self._run(future, func, args, kwargs)
+            self.jobs.task_done()
+        print("Print spooler exiting")
+
+    def _run(self, future: Future, func: Callable, args, kwargs):
+        for attempt in range(self.retries + 1):
+            self._connect()
+            if self.printer is None:
+                future.set_exception(RuntimeError("Spooler stopped before the printer came back"))
+                return
+            try:
+                with STAGE_SECONDS.time(stage="usb_transfer"):
+                    result = func(*args, printer=self.printer, **kwargs)
+                future.set_result(result)
+                return
+            except Exception as e:
+                PRINT_FAILURES.inc()
+                print(f"Print job failed ({e}), reconnecting printer (attempt {attempt + 1})")
+                self._disconnect()
+                self.reconnect_count += 1
+                if attempt == self.retries:
+                    future.set_exception(e)
+                    return
+                time.sleep(self.reconnect_delay)
+
+
+class _DeviceStats:
+
+    def __init__(self):
+        self.jobs = 0
+        self.failed = 0
+        self.work = 0
+        self.busy = 0.0
+        self.pending = 0
+
+
+class PrintScheduler:
+    """
+    Spreads print jobs over several printers, each with its own PrintSpooler,
+    so all devices print at the same time.
+
+    *policy* decides where a job goes:
+        round-robin: to the next device in turn
+        least-work:  to the device with the least work still queued
+        mirror:      to every device (e.g. the same newsletter on every table)
+
+    Jobs are submitted like with PrintSpooler, plus an optional *work* weight
+    (rows, bytes, ...) that least-work balances on and report() divides by
+    the time the device was busy. Instead of a function, the name of a
+    printers.Backend method ("print_raster") can be given; it is looked up on
+    the backend of whichever device gets the job, so mixed models work.
+    Packed rows cannot be scaled: give their *width* in dots and the job only
+    goes to devices with a line at least that wide.
+    """
+
+    POLICIES = ("round-robin", "least-work", "mirror")
+
+    def __init__(self, devices: list, policy: str = "round-robin", **spooler_args):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown policy {policy!r}, use one of {', '.join(self.POLICIES)}")
+        if not devices:
+            raise ValueError("No printers to schedule on")
+        self.devices = devices
+        self.policy = policy
+        self.spoolers = [PrintSpooler(device.open, **spooler_args) for device in devices]
+        self.stats = [_DeviceStats() for _ in devices]
+        self.lock = threading.Lock()
+        self.next = 0
+        self.started = None
+
+    def start(self):
+        for spooler in self.spoolers:
+            spooler.start()
+        self.started = time.perf_counter()
+        return self
+
+    def stop(self, timeout: float | None = None):
+        """Print everything still queued on every device, then release them."""
+        for spooler in self.spoolers:
+            spooler.stop(timeout)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def _pick(self, width: int | None = None) -> list[int]:
+        eligible = [i for i, device in enumerate(self.devices)
+                    if width is None or device.backend.width_dots >= width]
+        if not eligible:
+            raise ValueError(f"No printer has a line of {width} dots")
+        with self.lock:
+            if self.policy == "mirror":
+                return eligible
+            if self.policy == "least-work":
+                return [min(eligible, key=lambda i: self.stats[i].pending)]
+            while self.next not in eligible:
+                self.next = (self.next + 1) % len(self.spoolers)
+            index = self.next
+            self.next = (self.next + 1) % len(self.spoolers)
+            return [index]
+
+    def _submit_to(self, index: int, work: float, func: Callable | str, args, kwargs) -> Future:
+        stats = self.stats[index]
+        if isinstance(func, str):
+            func = getattr(self.devices[index].backend, func)
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stats.busy += time.perf_counter() - start
+
+        def done(future: Future):
+            with self.lock:
+                stats.pending -= work
+                if future.exception() is None:
+                    stats.jobs += 1
+                    stats.work += work
+                else:
+                    stats.failed += 1
+
+        with self.lock:
+            stats.pending += work
+        future = self.spoolers[index].submit(timed, *args, **kwargs)
+        future.add_done_callback(done)
+        return future
+
+    def submit(self, func: Callable | str, *args, work: float = 1, width: int | None = None,
+               **kwargs) -> Future:
+        """
+        Queue func(*args, printer=<handle>, **kwargs) on the device(s) the
+        policy picks among those at least *width* dots wide. Blocks while that
+        device's queue is full. The Future resolves once the job is printed
+        everywhere it was sent. Raises ValueError if no device is wide enough.
+        """
+        futures = [self._submit_to(i, work, func, args, kwargs) for i in self._pick(width)]
+        if len(futures) == 1:
+            return futures[0]
+
+        combined = Future()
+        remaining = [len(futures)]
+
+        def one_done(future: Future):
+            with self.lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                errors = [f.exception() for f in futures if f.exception() is not None]
+                if errors:
+                    combined.set_exception(errors[0])
+                else:
+                    combined.set_result([f.result() for f in futures])
+
+        for future in futures:
+            future.add_done_callback(one_done)
+        return combined
+
+    def join(self):
+        """Block until every submitted job has been handled on every device."""
+        for spooler in self.spoolers:
+            spooler.join()
+
+    def report(self) -> list[dict]:
+        """Per-device jobs, failures and throughput since start()."""
+        elapsed = time.perf_counter() - self.started if self.started else 0
+        rows = []
+        for device, stats in zip(self.devices, self.stats):
+            rows.append({
+                "device": device.name,
+                "jobs": stats.jobs,
+                "failed": stats.failed,
+                "work": stats.work,
+                "busy_s": round(stats.busy, 2),
+                "jobs_per_min": round(stats.jobs / elapsed * 60, 1) if elapsed else 0,
+                "work_per_s": round(stats.work / stats.busy, 1) if stats.busy else 0,
+            })
+        return rows
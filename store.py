@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+import hashlib
+import html
+import re
+import sqlite3
+import threading
+import time
+
+
+# Mailchimp adds ?e=<subscriber id> to every link, it does not change the page
+TRACKING_PARAMS = {"e"}
+
+
+def normalise_url(url: str) -> str:
+    """
+    Normalise an article URL so the same newsletter always maps to the same key:
+    lower-case scheme and host, no fragment, no trailing slash and no
+    tracking parameters.
+    """
+    parts = urlsplit(url.strip())
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+             if k not in TRACKING_PARAMS and not k.startswith("utm_")]
+    path = parts.path.rstrip("/") or "/"
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), path, urlencode(query), ""))
+
+
+def url_key(url: str) -> str:
+    """Short stable key for a normalised URL, e.g. for the raster archive."""
+    return hashlib.sha1(normalise_url(url).encode()).hexdigest()[:16]
+
+
+# Parts of a page that differ between two downloads of the same newsletter
+_VOLATILE = re.compile(r"<script\b.*?</script\s*>|<!--.*?-->|\snonce=\"[^\"]*\"", re.S | re.I)
+_LINK = re.compile(r"https?://[^\s\"'<>()]+")
+
+
+def normalise_html(page: str) -> str:
+    """
+    Reduce a newsletter page to what decides how it looks: scripts, comments
+    and nonces are dropped, links lose their tracking parameters (the
+    subscriber id differs per download) and whitespace is collapsed.
+    """
+    page = _VOLATILE.sub("", page)
+    page = _LINK.sub(lambda m: normalise_url(html.unescape(m.group(0))), page)
+    return " ".join(page.split())
+
+
+def html_hash(page: str) -> str:
+    """SHA-256 of the normalised *page*, equal for two downloads of an unchanged newsletter."""
+    return hashlib.sha256(normalise_html(page).encode()).hexdigest()
+
+
+class NewsletterStore:
+    """
+    Small SQLite index of every article URL the daemon has seen, keyed by the
+    normalised URL. It records how far each newsletter got (rendered,
+    printed, failed) and which raster archive entry holds its printer-ready
+    rows, so duplicates are recognised with one primary-key lookup and
+    reprints never go near the browser.
+    For archive refreshes (get_all.py) it also keeps the HTTP validators and
+    the html_hash of the version that was last rendered.
+    """
+
+    def __init__(self, path: str = "prnti.db"):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS newsletters (
+                url TEXT PRIMARY KEY,
+                state TEXT NOT NULL,
+                raster_key TEXT,
+                updated REAL NOT NULL
+            )
+        """)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS validators (
+                url TEXT PRIMARY KEY,
+                etag TEXT,
+                last_modified TEXT,
+                html_hash TEXT,
+                checked REAL NOT NULL
+            )
+        """)
+        self.db.commit()
+
+    def get(self, url: str) -> dict | None:
+        """Return the record of *url* (any form of it) or None if it was never seen."""
+        with self.lock:
+            row = self.db.execute("SELECT * FROM newsletters WHERE url = ?",
+                                  (normalise_url(url),)).fetchone()
+        return dict(row) if row else None
+
+    def set_state(self, url: str, state: str, raster_key: str | None = None):
+        """Record that *url* reached *state*, keeping an earlier raster key unless a new one is given."""
+        with self.lock:
+            self.db.execute("""
+                INSERT INTO newsletters (url, state, raster_key, updated) VALUES (?, ?, ?, ?)
+                ON CONFLICT(url) DO UPDATE SET
+                    state = excluded.state,
+                    raster_key = COALESCE(excluded.raster_key, newsletters.raster_key),
+                    updated = excluded.updated
+            """, (normalise_url(url), state, raster_key, time.time()))
+            self.db.commit()
+
+    def get_validators(self, url: str) -> dict | None:
+        """Return etag, last_modified and html_hash of the rendered version of *url*, or None."""
+        with self.lock:
+            row = self.db.execute("SELECT * FROM validators WHERE url = ?",
+                                  (normalise_url(url),)).fetchone()
+        return dict(row) if row else None
+
+    def set_validators(self, url: str, etag: str | None, last_modified: str | None, html_hash: str | None):
+        with self.lock:
+            self.db.execute("""
+                INSERT INTO validators (url, etag, last_modified, html_hash, checked) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(url) DO UPDATE SET
+                    etag = excluded.etag,
+                    last_modified = excluded.last_modified,
+                    html_hash = excluded.html_hash,
+                    checked = excluded.checked
+            """, (normalise_url(url), etag, last_modified, html_hash, time.time()))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+"""
+Process supervision for the parts of prnti that can hang: the IMAP session
+and Chromium. Each runs in a child process of its own session (process
+group), so a stuck socket or browser is not waited for but killed, together
+with everything it started, and replaced by a fresh one. What a child records in its metrics is sent
+back to the parent's registry along with its results.
+
+    ProcessMailMonitor  drop-in for mailbox.MailMonitor, the session lives
+                        in a child and hands messages back over a queue
+    RenderWorker        a warm browser in a child, every page gets a hard
+                        deadline
+
+Restarts are bounded by a RestartPolicy: a worker that keeps dying backs off
+and, past the budget, sets its *failed* event and gives up, so the daemon
+can exit and let systemd start it from scratch instead of spinning. Workers
+can share one *failed* event for that.
+"""
+
+from mailbox import MailSession
+from metrics import REGISTRY, WORKER_RESTARTS
+from typing import Optional
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+
+
+# spawn, not fork: the parent has threads (and possibly Playwright) running,
+# a forked copy of those would inherit their locks mid-flight
+_mp = multiprocessing.get_context("spawn")
+
+
+class WorkerFailed(Exception):
+    """A worker used up its restart budget."""
+
+
+class RestartPolicy:
+    """
+    Allow at most *max_restarts* restarts within *window* seconds. The n-th
+    restart in the window waits *backoff* * 2**(n-1) seconds, at most *max_delay*.
+    """
+
+    def __init__(self, max_restarts: int = 5, window: float = 600,
+                 backoff: float = 1, max_delay: float = 60):
+        self.max_restarts = max_restarts
+        self.window = window
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.restarts = []
+
+    def next_delay(self) -> float | None:
+        """Record a restart and return how long to wait first, or None if over budget."""
+        now = time.monotonic()
+        self.restarts = [t for t in self.restarts if now - t < self.window]
+        if len(self.restarts) >= self.max_restarts:
+            return None
+        self.restarts.append(now)
+        return min(self.max_delay, self.backoff * 2 ** (len(self.restarts) - 1))
+
+
+def _detach():
+    """Run in a child: become a process group leader and exit cleanly on SIGTERM."""
+    os.setsid()
+    signal.signal(signal.SIGTERM, lambda sig, frame: sys.exit(0))
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl-C is the parent's business
+
+
+def kill_worker(process, grace: float = 5):
+    """
+    Stop *process* and everything it started: SIGTERM to its process group,
+    SIGKILL after *grace* seconds, then SIGKILL once more for any grandchild
+    (Chromium) that outlived it.
+    """
+    if process is None or process.pid is None:
+        return
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except (ProcessLookupError, PermissionError):
+        pass
+    process.join(grace)
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+    process.join()
+    process.close()
+
+
+def _mail_process(settings: dict, messages, heartbeat, connected, mail_timeout: int):
+    """Child side of ProcessMailMonitor."""
+    _detach()
+
+    def beat():
+        heartbeat.value = time.time()
+
+    session = MailSession(heartbeat=beat, **settings)
+    print(f"Mail worker process {os.getpid()} started")
+    try:
+        while True:
+            try:
+                beat()
+                session.connect()
+                connected.set()
+                msgs = session.wait_for_mail(mail_timeout)
+                beat()
+                for msg in msgs:
+                    messages.put(msg)
+                    print(f"Mail worker process {os.getpid()} found message: {msg.subject}")
+            except Exception as e:
+                print(f"Error in mail worker process {os.getpid()}: {e}")
+                session.close()
+                beat()
+                time.sleep(10)
+            finally:
+                delta = REGISTRY.drain()
+                if delta:
+                    messages.put(delta)
+    finally:
+        session.close()
+        print(f"Mail worker process {os.getpid()} exiting")
+
+
+class ProcessMailMonitor:
+    """
+    Mail monitor whose IMAP session runs in a child process.
+
+    Same interface as mailbox.MailMonitor, but a session that stops sending
+    heartbeats for *watchdog_timeout* seconds is killed, socket and all,
+    before the next one is started: there is never more than one connection,
+    so no two sessions can race to deliver the same mail.
+    """
+
+    def __init__(self, sender: str, host: str, username: str, password: str,
+                 folder: str = 'INBOX', mail_timeout: int = 300, watchdog_timeout: int = 120,
+                 port: Optional[int] = None, ssl: bool = True, state_path: str = 'mail_state.json',
+                 policy: RestartPolicy | None = None, failed: threading.Event | None = None):
+        self.settings = dict(sender=sender, host=host, username=username, password=password,
+                             folder=folder, port=port, ssl=ssl, state_path=state_path)
+        self.mail_timeout = mail_timeout
+        self.watchdog_timeout = watchdog_timeout
+        self.policy = policy or RestartPolicy()
+
+        self.mail_queue = _mp.Queue()
+        self.heartbeat = _mp.Value("d", time.time(), lock=False)
+        self.connected = _mp.Event()  # set once the first session has logged in
+        self.process = None
+        self.watchdog_thread = None
+        self.stop_event = threading.Event()
+        self.failed = failed or threading.Event()  # set when the restart budget is used up
+        self.restart_count = 0
+
+    def _spawn(self):
+        self.heartbeat.value = time.time()
+        self.process = _mp.Process(target=_mail_process, name="prnti-mail", daemon=True,
+                                   args=(self.settings, self.mail_queue, self.heartbeat,
+                                         self.connected, self.mail_timeout))
+        self.process.start()
+
+    def _watchdog_worker(self):
+        print("Watchdog thread started")
+        while not self.stop_event.wait(10):
+            idle = time.time() - self.heartbeat.value
+            if self.process.is_alive() and idle <= self.watchdog_timeout:
+                continue
+            if self.process.is_alive():
+                print(f"Mail process {self.process.pid} is hanging (no activity for {idle:.1f}s), killing it")
+            else:
+                print(f"Mail process {self.process.pid} died with exit code {self.process.exitcode}")
+            kill_worker(self.process)
+            self.process = None
+            delay = self.policy.next_delay()
+            if delay is None:
+                print(f"Mail process restarted {self.policy.max_restarts} times in "
+                      f"{self.policy.window:.0f}s, giving up")
+                self.failed.set()
+                break
+            self.restart_count += 1
+            WORKER_RESTARTS.inc(worker="mail")
+            print(f"Restarting mail process in {delay:.0f}s (restart #{self.restart_count})")
+            if self.stop_event.wait(delay):
+                break
+            self._spawn()
+        print("Watchdog thread exiting")
+
+    def start(self):
+        print("Starting MailMonitor (process)...")
+        self.stop_event.clear()
+        self._spawn()
+        self.watchdog_thread = threading.Thread(target=self._watchdog_worker, daemon=True)
+        self.watchdog_thread.start()
+        print("MailMonitor started successfully")
+
+    def stop(self):
+        print("Stopping MailMonitor...")
+        self.stop_event.set()
+        if self.watchdog_thread and self.watchdog_thread.is_alive():
+            self.watchdog_thread.join(timeout=15)
+        if self.process is not None:
+            kill_worker(self.process)
+            self.process = None
+        print("MailMonitor stopped")
+
+    def get_message(self, timeout: Optional[float] = None) -> Optional[object]:
+        """Get a message from the mail queue, None if *timeout* is reached."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            try:
+                item = self.mail_queue.get(timeout=remaining)
+            except queue.Empty:
+                return None
+            if not isinstance(item, dict):
+                return item
+            REGISTRY.merge(item)  # the child's metrics
+
+    def get_restart_count(self) -> int:
+        """Get the number of times the mail process has been restarted."""
+        return self.restart_count
+
+
+def _render_process(conn, pool_args: dict, cache_args: dict | None):
+    """Child side of RenderWorker: one warm browser, requests in, PNG bands out."""
+    _detach()
+    from browser import BrowserPool, screenshot_bands
+    from assets import AssetCache
+    asset_cache = AssetCache(**cache_args) if cache_args else None
+    pool = BrowserPool(size=1, asset_cache=asset_cache, **pool_args)
+    try:
+        pool.start()
+        conn.send(("ready", None))
+        while True:
+            request = conn.recv()
+            if request is None:
+                break
+            try:
+                for band in screenshot_bands(pool=pool, **request):
+                    conn.send(("band", band))
+                conn.send(("done", REGISTRY.drain()))
+            except Exception as e:
+                conn.send(("error", (e, REGISTRY.drain())))
+    except (EOFError, BrokenPipeError):
+        pass  # the parent is gone
+    finally:
+        pool.stop()
+        if asset_cache is not None:
+            asset_cache.close()
+
+
+class RenderWorker:
+    """
+    A browser in a child process, with a hard *deadline* in seconds per page.
+
+    bands() yields the page as print-ready images like browser.capture_bands.
+    If the page is not done in time, the worker and its Chromium are killed,
+    the call raises TimeoutError (RuntimeError if it crashed) and the next
+    call starts a fresh browser, as long as the RestartPolicy allows it.
+    """
+
+    def __init__(self, deadline: float = 180, print_width: int | None = None,
+                 device_name: str = "iPhone 12", max_pages: int = 50, max_rss_mb: int = 700,
+                 asset_cache_dir: str | None = None, asset_cache_mb: int = 200,
+                 policy: RestartPolicy | None = None, failed: threading.Event | None = None):
+        self.deadline = deadline
+        self.pool_args = dict(device_name=device_name, max_pages=max_pages, max_rss_mb=max_rss_mb,
+                              print_width=print_width)
+        self.cache_args = dict(directory=asset_cache_dir, max_mb=asset_cache_mb) if asset_cache_dir else None
+        self.policy = policy or RestartPolicy()
+        self.process = None
+        self.conn = None
+        self.failed = failed or threading.Event()
+        self.restart_count = 0
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def start(self):
+        """Launch the worker and wait until its browser is up (at most *deadline* seconds)."""
+        if self.process is not None:
+            if self.process.is_alive():
+                return self
+            self._restart(f"died while idle (exit code {self.process.exitcode})")
+        self.conn, child = _mp.Pipe()
+        self.process = _mp.Process(target=_render_process, name="prnti-render", daemon=True,
+                                   args=(child, self.pool_args, self.cache_args))
+        self.process.start()
+        child.close()
+        self._receive(time.monotonic() + self.deadline, "starting the browser")
+        print(f"Render worker process {self.process.pid} ready")
+        return self
+
+    def stop(self):
+        if self.process is None:
+            return
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        kill_worker(self.process, grace=10)
+        self.conn.close()
+        self.process = self.conn = None
+
+    def _restart(self, reason: str):
+        print(f"Render worker {reason}, killing process {self.process.pid}")
+        kill_worker(self.process)
+        self.conn.close()
+        self.process = self.conn = None
+        delay = self.policy.next_delay()
+        if delay is None:
+            self.failed.set()
+            raise WorkerFailed(f"render worker restarted {self.policy.max_restarts} times in "
+                               f"{self.policy.window:.0f}s, giving up")
+        self.restart_count += 1
+        WORKER_RESTARTS.inc(worker="render")
+        time.sleep(delay)
+
+    def _receive(self, deadline: float, what: str):
+        """Next message from the worker, restarting it if it misses *deadline*."""
+        try:
+            if self.conn.poll(max(0, deadline - time.monotonic())):
+                return self.conn.recv()
+        except (EOFError, OSError):
+            reason = f"died {what}"
+            self._restart(reason)
+            raise RuntimeError(f"Render worker {reason}") from None
+        reason = f"missed the {self.deadline:.0f}s deadline {what}"
+        self._restart(reason)
+        raise TimeoutError(f"Render worker {reason}")
+
+    def bands(self, url: str, band_height: int | None = 600, width: int = 830,
+              max_pixels: int | None = None, split: bool = True):
+        """
+        Yield the page at *url* as print-ready images, bottom band first,
+        see browser.screenshot_bands for the arguments. The deadline covers
+        the whole page, not each band, but only the time spent waiting for
+        the worker: while the caller holds a band (say, the printer is out of
+        paper) the clock stops.
+        """
+        from browser import band_image
+        if self.failed.is_set():
+            raise WorkerFailed("render worker gave up")
+        self.start()
+        budget = self.deadline
+
+        def receive():
+            nonlocal budget
+            started = time.monotonic()
+            try:
+                return self._receive(started + budget, f"rendering {url}")
+            finally:
+                budget -= time.monotonic() - started
+
+        self.conn.send(dict(url=url, band_height=band_height, width=width,
+                            max_pixels=max_pixels, split=split))
+        finished = False
+        try:
+            while True:
+                kind, value = receive()
+                if kind == "done":
+                    finished = True
+                    REGISTRY.merge(value)
+                    return
+                if kind == "error":
+                    finished = True
+                    error, delta = value
+                    REGISTRY.merge(delta)
+                    raise error
+                yield band_image(*value, width)
+        finally:
+            # the caller gave up early: drain the rest of the page, so the
+            # next request does not read its bands
+            while not finished and self.conn is not None:
+                kind, value = receive()
+                if kind in ("done", "error"):
+                    finished = True
+                    REGISTRY.merge(value if kind == "done" else value[1])
@@ -1,27 +1,37 @@
 #!/usr/bin/env python
+"""Star TSP800, see printers.py."""
 
-from escpos.printer import Usb
+from printers import get_backend
 
 
-VENDOR_ID = 0x0519
-PRODUCT_ID = 0x0001
-PROFILE= "TSP800"
+backend = get_backend("tsp800")
 
-allowed_images = ['.jpg', '.jpeg', '.gif', '.png', '.bmp']
+VENDOR_ID = backend.vendor_id
+PRODUCT_ID = backend.product_id
+PROFILE = backend.profile
 
-def print_image(filename,cut=True):
-    p = Usb(VENDOR_ID, PRODUCT_ID, 0, profile=PROFILE)
-    assert filename.endswith(tuple(allowed_images)), "File type not supported"
-    p.image(filename)
-    if cut: p.cut()
-    p.close()
+def connect():
+    """Open the printer. Pass the handle as *printer* to keep it open across jobs."""
+    return backend.open()
 
-def print_text(text,cut=True):
-    p = Usb(VENDOR_ID, PRODUCT_ID, 0, profile=PROFILE)
-    p.text(text)
-    if cut: p.cut()
-    p.close()
+def print_image(image,cut=True,printer=None):
+    backend.print_image(image, cut=cut, printer=printer)
+
+def print_raster(rows,width_bytes,height,cut=True,printer=None):
+    """Stream packed 1-bit rows (see raster.pack_image) to the printer as-is."""
+    backend.print_raster(rows, width_bytes, height, cut=cut, printer=printer)
+
+def print_commands(commands,cut=False,printer=None):
+    """Send ready-made ESC/POS *commands* (see hybrid.render_html) to the printer."""
+    backend.print_commands(commands, cut=cut, printer=printer)
+
+def feed(rows,cut=False,printer=None):
+    """Advance the paper by *rows* dot rows, much cheaper than printing a blank image."""
+    backend.feed(rows, cut=cut, printer=printer)
+
+def print_text(text,cut=True,printer=None):
+    backend.print_text(text, cut=cut, printer=printer)
 
 
 if __name__=="__main__":
-    print_image("whitespace.jpg",cut=False)
+    feed(1700)